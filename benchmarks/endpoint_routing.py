@@ -0,0 +1,86 @@
+# benchmarks/endpoint_routing.py
+# Drives utils.endpoint_router.EndpointRouter against local stub servers (benchmarks/stub_llm_server.py)
+# and compares: first endpoint only, EWMA routing with failover, and routing with hedging.
+#
+#   python benchmarks/endpoint_routing.py
+#   python benchmarks/endpoint_routing.py --requests 400 --concurrency 16
+#
+# Default upstreams: a fast one with a slow tail, a steady slower one, a flaky one answering 500s,
+# and a port with nothing listening (connection refused).
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aiohttp
+
+from stub_llm_server import Profile, start_stubs
+from utils import json_codec
+from utils.endpoint_router import Endpoint, EndpointRouter
+
+DEFAULT_PROFILES = ["9101:0.15:0.05:0:0.1:3", "9102:0.4:0.1", "9103:0.1:0.02:0.3"]
+DEAD_PORT = 9109
+
+
+def url(port: int) -> str:
+    return f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+async def run(name: str, router: EndpointRouter, session, requests: int, concurrency: int):
+    body = json_codec.dumps({"model": "stub", "messages": [{"role": "user", "content": "hello"}]})
+    headers = {"Content-Type": "application/json"}
+    latencies, statuses, errors = [], {}, 0
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with gate:
+            started = time.monotonic()
+            try:
+                response = await router.request(session, body, headers, timeout=10.0)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            except Exception:
+                errors += 1
+            latencies.append(time.monotonic() - started)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    ordered = sorted(latencies)
+    pct = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    print(f"{name:22} p50={pct(0.5):6.3f}s p95={pct(0.95):6.3f}s p99={pct(0.99):6.3f}s mean={statistics.mean(ordered):6.3f}s "
+          f"ok={statuses.get(200, 0)} 5xx={sum(v for k, v in statuses.items() if k >= 500)} errors={errors} "
+          f"hedged={router.hedged} failovers={router.failovers}")
+    for e in router.stats():
+        print(f"    {e['name']:45} ok={e['successes']:4} failed={e['failures']:4} hedges_won={e['hedges_won']:3}")
+
+
+async def main_async(args):
+    profiles = [Profile.parse(s) for s in args.profiles]
+    runners = await start_stubs(profiles)
+    urls = [url(p.port) for p in profiles] + [url(DEAD_PORT)]
+    try:
+        async with aiohttp.ClientSession() as session:
+            await run("first endpoint only", EndpointRouter([Endpoint(urls[0])]), session, args.requests, args.concurrency)
+            await run("ewma + failover", EndpointRouter([Endpoint(u) for u in urls]), session, args.requests, args.concurrency)
+            await run("ewma + failover + hedge", EndpointRouter([Endpoint(u) for u in urls], hedge=True, hedge_min_delay=args.hedge_min_delay),
+                      session, args.requests, args.concurrency)
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endpoint routing / failover / hedging benchmark against local stubs.")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--hedge-min-delay", type=float, default=0.2)
+    parser.add_argument("--profiles", nargs="+", default=DEFAULT_PROFILES, help="Stub specs, see stub_llm_server.py")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
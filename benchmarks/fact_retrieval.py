@@ -0,0 +1,89 @@
+# benchmarks/fact_retrieval.py
+# Cost of picking the top-k relevant facts (utils/fact_index.py) for users with large memories: building a
+# user's index, appending one learned fact, and per-query latency, plus how much of the prompt's fact block
+# that saves compared with sending every fact. Queries are a prompt plus a couple of history turns, as
+# AICog.select_facts builds them; each query after an append pays for folding it in, as in the cog.
+#
+#   python benchmarks/fact_retrieval.py                       # 100 .. 20k facts
+#   python benchmarks/fact_retrieval.py --facts 5000 --no-numpy
+#
+# Facts are synthetic: short sentences drawn from a topic vocabulary, so many facts share words and the
+# ranking has real work to do.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SUBJECTS = ("my cat", "my sister", "my best friend", "my job", "my school", "my favourite song", "my dog",
+            "my birthday", "my hometown", "my car", "my guitar", "my phone", "my cousin", "my boss", "my garden")
+VERBS = ("likes", "hates", "is called", "plays", "collects", "is learning", "wants", "listens to", "cooks", "visits")
+OBJECTS = ("oranges", "bananas", "road rollers", "vocaloid concerts", "piano covers", "leek recipes", "rhythm games",
+           "the seaside", "tokyo", "ribbons", "mirrors", "karaoke", "anime", "spicy ramen", "jazz", "chess", "minecraft",
+           "watercolor painting", "marathon training", "night drives", "thunderstorms", "sushi", "retro consoles")
+
+
+def make_facts(count: int, rng: random.Random):
+    return [f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} ({i})" for i in range(count)]
+
+
+def make_query(rng: random.Random) -> str:
+    prompt = f"hey what do you think about {rng.choice(OBJECTS)} and {rng.choice(SUBJECTS)}?"
+    history = [f"we talked about {rng.choice(OBJECTS)} yesterday", f"haha {rng.choice(SUBJECTS)} would love that"]
+    return "\n".join([prompt] + history)
+
+
+def percentile(ordered, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(count: int, queries: int, k: int):
+    from utils.fact_index import FactIndex
+    rng = random.Random(count)
+    facts = make_facts(count, rng)
+
+    started = time.perf_counter()
+    index = FactIndex(facts)
+    index.top_k(make_query(rng), k) # The first query does the (NumPy) build
+    build = time.perf_counter() - started
+
+    times, add_times = [], []
+    for q in range(queries):
+        query = make_query(rng)
+        if q % 10 == 0: # A fact learned every tenth message
+            fact = f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} (new {q})"
+            started = time.perf_counter()
+            index.add(fact)
+            add_times.append(time.perf_counter() - started)
+            facts.append(fact)
+        started = time.perf_counter()
+        positions = index.top_k(query, k)
+        times.append(time.perf_counter() - started)
+    times.sort()
+
+    all_chars = sum(len(f) + 3 for f in facts)
+    top_chars = sum(len(facts[i]) + 3 for i in positions)
+    print(f"facts={count:>7,}  terms {index.terms:>8,}  build {build * 1000:8.1f} ms   add {sum(add_times) / len(add_times) * 1e6:6.1f} us   "
+          f"query p50 {percentile(times, 0.5) * 1000:7.3f} ms  p99 {percentile(times, 0.99) * 1000:7.3f} ms   "
+          f"fact block {all_chars:>9,} -> {top_chars:>4,} chars")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Top-k fact retrieval latency per user memory size.")
+    parser.add_argument("--facts", type=int, nargs="+", default=[100, 1_000, 5_000, 20_000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8, help="Facts per prompt (AI_FACT_TOP_K).")
+    parser.add_argument("--no-numpy", action="store_true", help="Make fact_index use its pure-Python scoring.")
+    args = parser.parse_args()
+    if args.no_numpy:
+        sys.modules["numpy"] = None # Makes `import numpy` raise ImportError
+    from utils import fact_index
+    print(f"fact index backend: {fact_index.BACKEND}")
+    for count in args.facts:
+        run(count, args.queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
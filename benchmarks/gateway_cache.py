@@ -0,0 +1,169 @@
+# benchmarks/gateway_cache.py
+# RSS and startup time of the "default" and "lean" cache profiles (utils/cache_profile.py) with many
+# guilds. Nothing connects to Discord: synthetic READY / GUILD_CREATE payloads and a stream of gateway
+# events are fed straight into discord.py's ConnectionState parsers, skipping the events Discord would
+# not send for the profile's intents. Each profile runs in a fresh subprocess.
+#
+#   python benchmarks/gateway_cache.py                       # 2k and 10k guilds
+#   python benchmarks/gateway_cache.py --guilds 25000 --events 200000
+#
+# Guilds are shaped like typical community servers: ~25 channels, ~15 roles, ~30 emojis, a few members
+# in voice. The event mix is messages (with author member data), typing, reactions and voice updates.
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BOT_ID = 100
+# (event, share of traffic, intent that must be enabled for Discord to send it)
+EVENT_MIX = [
+    ("MESSAGE_CREATE", 0.55, "guild_messages"),
+    ("TYPING_START", 0.25, "guild_typing"),
+    ("MESSAGE_REACTION_ADD", 0.15, "guild_reactions"),
+    ("VOICE_STATE_UPDATE", 0.05, "voice_states"),
+]
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def user_payload(user_id: int):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "global_name": f"User {user_id}",
+            "avatar": None, "bot": user_id == BOT_ID}
+
+
+def member_payload(user_id: int, roles, with_user: bool = True):
+    data = {"roles": roles, "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0, "nick": None}
+    if with_user:
+        data["user"] = user_payload(user_id)
+    return data
+
+
+def guild_payload(guild_id: int, rng: random.Random):
+    base = guild_id * 1000
+    roles = [{"id": str(guild_id), "name": "@everyone", "permissions": "1071698660929", "position": 0, "color": 0,
+              "hoist": False, "managed": False, "mentionable": False, "flags": 0}]
+    roles += [{"id": str(base + 100 + r), "name": f"role {r}", "permissions": "1071698660929", "position": r + 1,
+               "color": rng.randrange(0xFFFFFF), "hoist": False, "managed": False, "mentionable": True, "flags": 0}
+              for r in range(15)]
+    channels = [{"id": str(base + c), "type": 0 if c % 5 else 2, "name": f"channel-{c}", "position": c,
+                 "permission_overwrites": [], "nsfw": False, "parent_id": None, "topic": "general chatter",
+                 "rate_limit_per_user": 0, "bitrate": 64000, "user_limit": 0}
+                for c in range(25)]
+    emojis = [{"id": str(base + 500 + e), "name": f"emoji{e}", "roles": [], "require_colons": True, "managed": False,
+               "animated": False, "available": True} for e in range(30)]
+    voice_users = [guild_id * 100000 + v for v in range(rng.randrange(0, 6))]
+    return {
+        "id": str(guild_id), "name": f"Guild {guild_id}", "icon": None, "owner_id": str(guild_id * 100000 + 99),
+        "region": "us-west", "afk_channel_id": None, "afk_timeout": 300, "verification_level": 1,
+        "default_message_notifications": 1, "explicit_content_filter": 0, "features": ["COMMUNITY"],
+        "mfa_level": 0, "system_channel_id": str(base), "system_channel_flags": 0, "rules_channel_id": None,
+        "max_members": 500000, "vanity_url_code": None, "description": None, "banner": None, "premium_tier": 1,
+        "premium_subscription_count": 3, "preferred_locale": "en-US", "public_updates_channel_id": None,
+        "nsfw_level": 0, "premium_progress_bar_enabled": False, "large": True, "unavailable": False,
+        "member_count": rng.randrange(50, 20000), "roles": roles, "channels": channels, "emojis": emojis,
+        "stickers": [], "threads": [], "stage_instances": [], "guild_scheduled_events": [], "soundboard_sounds": [],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "members": [member_payload(BOT_ID, [str(base + 114)])] + [member_payload(u, [str(base + 101)]) for u in voice_users],
+        "voice_states": [{"user_id": str(u), "channel_id": str(base + 5), "session_id": "s", "deaf": False, "mute": False,
+                          "self_deaf": False, "self_mute": False, "self_video": False, "suppress": False,
+                          "request_to_speak_timestamp": None} for u in voice_users],
+        "presences": [],
+    }
+
+
+def event_payload(kind: str, guilds: int, rng: random.Random, message_id: int):
+    guild_id = 1 + rng.randrange(guilds)
+    base = guild_id * 1000
+    channel_id = str(base + 1 + rng.randrange(24))
+    user_id = guild_id * 100000 + rng.randrange(400) # A few hundred active members per guild
+    if kind == "MESSAGE_CREATE":
+        return {"id": str(message_id), "channel_id": channel_id, "guild_id": str(guild_id), "author": user_payload(user_id),
+                "member": member_payload(user_id, [str(base + 101)], with_user=False),
+                "content": "hey everyone, what's up? " * rng.randint(1, 4), "timestamp": "2024-01-01T00:00:00+00:00",
+                "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+                "attachments": [], "embeds": [], "pinned": False, "type": 0, "flags": 0}
+    if kind == "TYPING_START":
+        return {"channel_id": channel_id, "guild_id": str(guild_id), "user_id": str(user_id), "timestamp": 1700000000,
+                "member": member_payload(user_id, [str(base + 101)])}
+    if kind == "MESSAGE_REACTION_ADD":
+        return {"user_id": str(user_id), "channel_id": channel_id, "message_id": str(max(1, message_id - 5)),
+                "guild_id": str(guild_id), "emoji": {"id": None, "name": "🍊"}, "type": 0, "burst": False,
+                "member": member_payload(user_id, [str(base + 101)])}
+    return {"guild_id": str(guild_id), "channel_id": str(base + 5), "user_id": str(user_id), "session_id": "s",
+            "deaf": False, "mute": False, "self_deaf": False, "self_mute": False, "self_video": False, "suppress": False,
+            "request_to_speak_timestamp": None, "member": member_payload(user_id, [str(base + 101)])}
+
+
+async def run_profile(profile: str, guilds: int, events: int):
+    from discord.ext import commands
+    from utils.cache_profile import build_client_options
+
+    options = build_client_options(profile)
+    bot = commands.Bot(command_prefix="/", **options)
+    async with bot: # Sets up the client's loop without logging in
+        await _feed(bot, profile, options["intents"], guilds, events)
+
+
+async def _feed(bot, profile: str, intents, guilds: int, events: int):
+    state = bot._connection
+    rng = random.Random(1)
+    payloads = [guild_payload(g, rng) for g in range(1, guilds + 1)] # Built before measuring
+    baseline = rss_mb()
+
+    started = time.perf_counter()
+    state.parsers["READY"]({"v": 10, "user": user_payload(BOT_ID), "guilds": [{"id": str(g), "unavailable": True} for g in range(1, guilds + 1)],
+                            "session_id": "bench", "resume_gateway_url": "wss://localhost", "application": {"id": "100", "flags": 0}})
+    for payload in payloads:
+        state.parsers["GUILD_CREATE"](payload)
+    startup = time.perf_counter() - started
+    del payloads
+    if state._ready_task is not None:
+        state._ready_task.cancel()
+    after_startup = rss_mb()
+
+    mix = [(kind, share) for kind, share, intent in EVENT_MIX]
+    kinds = rng.choices([k for k, _ in mix], weights=[s for _, s in mix], k=events)
+    allowed = {kind for kind, _, intent in EVENT_MIX if getattr(intents, intent)}
+    handled = 0
+    started = time.perf_counter()
+    for i, kind in enumerate(kinds):
+        if kind not in allowed:
+            continue # Discord wouldn't send it
+        state.parsers[kind](event_payload(kind, guilds, rng, 10**9 + i))
+        handled += 1
+        if i % 500 == 0:
+            await asyncio.sleep(0) # Let the dispatched on_message tasks run
+    await asyncio.sleep(0)
+    traffic = time.perf_counter() - started
+    members = sum(len(g._members) for g in state._guilds.values())
+    messages = len(state._messages) if state._messages is not None else 0
+    print(f"{profile:8} guilds={guilds:>7,}  startup {startup * 1000:7.0f} ms  rss after startup {after_startup - baseline:7.1f} MB  "
+          f"after {events:,} events {rss_mb() - baseline:7.1f} MB ({handled:,} received in {traffic:5.1f}s)  "
+          f"cached: {members:,} members, {messages:,} messages")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway cache profile benchmark (RSS / startup time).")
+    parser.add_argument("--guilds", type=int, nargs="+", default=[2_000, 10_000])
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--child", nargs=2, metavar=("PROFILE", "GUILDS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(run_profile(args.child[0], int(args.child[1]), args.events))
+        return
+    for guilds in args.guilds:
+        for profile in ("default", "lean"):
+            subprocess.run([sys.executable, __file__, "--child", profile, str(guilds), "--events", str(args.events)], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# benchmarks/history_memory.py
+# Compares resident memory of the old conversation_history layout (dict of lists of
+# {"role", "content"} dicts) against the HistoryBuffer ring buffers in utils/history.py.
+# Each (layout, user count) runs in a fresh subprocess so RSS numbers don't bleed together.
+# For the ring layout it also times one save of the history file, streamed from the buffers by
+# write_histories_json and the old way (to_api for every user, then one json dump), with the
+# peak RSS growth of each (streamed runs first, since peak RSS only ever goes up).
+#
+#   python benchmarks/history_memory.py                      # 100k and 1M users, 20 messages each
+#   python benchmarks/history_memory.py --users 100000 --messages 8
+#
+# Message contents come from a small shared pool, so the numbers measure the per-user and
+# per-message container overhead rather than the text itself (which both layouts store the same way).
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONTENT_POOL = [f"sample message number {i} with a bit of text" for i in range(64)]
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def build(layout: str, users: int, messages: int, capacity: int):
+    from utils.history import HistoryBuffer
+    history = {}
+    for u in range(users):
+        user_id = str(100000000000000000 + u)
+        if layout == "legacy":
+            entries = history[user_id] = []
+            for m in range(messages):
+                entries.append({"role": "user" if m % 2 == 0 else "assistant", "content": CONTENT_POOL[(u + m) % 64]})
+                if len(entries) > capacity:
+                    history[user_id] = entries = entries[-capacity:] # Same re-slice the old add_to_history did
+        else:
+            buffer = history[user_id] = HistoryBuffer(capacity)
+            for m in range(messages):
+                buffer.append("user" if m % 2 == 0 else "assistant", CONTENT_POOL[(u + m) % 64])
+    return history
+
+
+def run_child(layout: str, users: int, messages: int, capacity: int):
+    baseline = rss_mb()
+    started = time.perf_counter()
+    history = build(layout, users, messages, capacity)
+    elapsed = time.perf_counter() - started
+    print(f"{layout:7} users={users:>9,} messages/user={messages:>3} rss_delta={rss_mb() - baseline:9.1f} MB build={elapsed:6.2f}s")
+    if layout == "ring":
+        save("streamed", history)
+        save("to_api", history)
+    del history
+
+
+def save(method: str, history):
+    from utils import json_codec
+    from utils.history import write_histories_json
+    before = rss_mb()
+    started = time.perf_counter()
+    with open(os.devnull, "wb") as f:
+        if method == "to_api":
+            f.write(json_codec.dumps({user_id: buffer.to_api() for user_id, buffer in history.items()}, indent=True))
+        else:
+            write_histories_json(history, f)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KiB on Linux
+    print(f"{'':7} save ({method:8}) {elapsed:6.2f}s peak_rss_growth={max(0.0, peak - before):9.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversation history memory benchmark.")
+    parser.add_argument("--users", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--messages", type=int, default=20, help="Messages appended per user.")
+    parser.add_argument("--capacity", type=int, default=20, help="History window (max_history_messages).")
+    parser.add_argument("--child", nargs=2, metavar=("LAYOUT", "USERS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], int(args.child[1]), args.messages, args.capacity)
+        return
+    for users in args.users:
+        for layout in ("legacy", "ring"):
+            subprocess.run([sys.executable, __file__, "--child", layout, str(users),
+                            "--messages", str(args.messages), "--capacity", str(args.capacity)], check=True)
+
+
+if __name__ == "__main__":
+    main()
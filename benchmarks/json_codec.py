@@ -0,0 +1,119 @@
+# benchmarks/json_codec.py
+# Per-turn JSON cost of an LLM request: encoding the request body and decoding the response.
+# Compares the old path (stdlib json via aiohttp's json= / response.json()) against utils.json_codec,
+# both re-encoding everything and with the tool schema + static system prompt pre-encoded.
+#
+#   python benchmarks/json_codec.py                    # orjson if installed
+#   python benchmarks/json_codec.py --no-orjson        # force the stdlib fallback inside json_codec
+#   python benchmarks/json_codec.py --history 40 --turns 20000
+#
+# The payload mirrors generate_completion: a ~3 KB persona prompt with per-user fields filled in,
+# the two tool definitions, the user's history window and the current message.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PERSONA = " ".join(
+    f"Persona rule {i}: stay in character as Kagamine Rin and Len, keep replies friendly, energetic and under the limit."
+    for i in range(30)
+)
+TEMPLATE = PERSONA + "\n\n{user_memory_context}\n\nADDITIONAL CONTEXT PROVIDED:\n{manual_context}\n\nDYNAMIC LEARNING EXAMPLES:\n{dynamic_learning_context}"
+
+TOOLS = [
+    {"type": "function", "function": {
+        "name": "run_safe_shell_command",
+        "description": "Executes a simple, safe, read-only shell command if necessary to answer a user's question (e.g., get current date, list files, check uptime). Prohibited commands include file modification, cat, sudo, etc.",
+        "parameters": {"type": "object", "properties": {"command": {"type": "string", "description": "The safe shell command to execute (e.g., 'date', 'ls -l', 'ping -c 1 google.com')."}}, "required": ["command"]},
+    }},
+    {"type": "function", "function": {
+        "name": "remember_fact_about_user",
+        "description": "Stores a concise fact learned about the user during the conversation (e.g., 'likes rock music', 'favorite food is ramen', 'has a cat named Mochi').",
+        "parameters": {"type": "object", "properties": {"user_id": {"type": "string", "description": "The Discord User ID of the user the fact pertains to."}, "fact": {"type": "string", "description": "The specific, concise fact to remember about the user."}}, "required": ["user_id", "fact"]},
+    }},
+]
+
+FIELDS = {
+    "user_memory_context": "Here's what we remember about Miku (User ID: 123456789012345678):\n- likes leeks\n- plays the piano",
+    "manual_context": "- The server's movie night is on Fridays.",
+    "dynamic_learning_context": "None provided.",
+}
+
+
+def make_history(count: int):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}: " + "la " * 40} for i in range(count)]
+
+
+def make_response() -> bytes:
+    return json.dumps({
+        "id": "chatcmpl-1", "object": "chat.completion", "created": 1700000000, "model": "Llama-3.3-70B-Instruct",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Yay! " + "Rin and Len say hi! " * 30}}],
+        "usage": {"prompt_tokens": 1800, "completion_tokens": 160, "total_tokens": 1960},
+    }).encode("utf-8")
+
+
+def base_payload(messages):
+    return {"model": "Llama-3.3-70B-Instruct", "messages": messages, "tool_choice": "auto",
+            "temperature": 0.8, "max_tokens": 2000, "top_p": 0.9, "frequency_penalty": 0.1, "presence_penalty": 0.1}
+
+
+def bench(name: str, turns: int, encode, decode, response: bytes):
+    size = len(encode())
+    started = time.perf_counter()
+    for _ in range(turns):
+        encode()
+    encode_us = (time.perf_counter() - started) / turns * 1e6
+    started = time.perf_counter()
+    for _ in range(turns):
+        decode(response)
+    decode_us = (time.perf_counter() - started) / turns * 1e6
+    print(f"{name:32} encode={encode_us:8.1f} us  decode={decode_us:6.1f} us  total={encode_us + decode_us:8.1f} us/turn  body={size:,} B")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON encode/decode cost per LLM turn.")
+    parser.add_argument("--turns", type=int, default=10_000)
+    parser.add_argument("--history", type=int, default=20, help="History messages in the request.")
+    parser.add_argument("--no-orjson", action="store_true", help="Make json_codec use its stdlib fallback.")
+    args = parser.parse_args()
+    if args.no_orjson:
+        sys.modules["orjson"] = None # Makes `import orjson` raise ImportError
+    from utils import json_codec
+    from utils.json_codec import PreEncoded, PreEncodedTemplate
+
+    history = make_history(args.history)
+    current = {"role": "user", "content": "Miku: what should we sing tonight?"}
+    response = make_response()
+    template = PreEncodedTemplate(TEMPLATE)
+    tools_encoded = PreEncoded.of(TOOLS)
+
+    def stdlib_encode():
+        messages = [{"role": "system", "content": TEMPLATE.format(**FIELDS)}] + history + [current]
+        payload = base_payload(messages)
+        payload["tools"] = TOOLS
+        return json.dumps(payload).encode("utf-8") # What aiohttp's json= does
+
+    def codec_encode():
+        messages = [{"role": "system", "content": TEMPLATE.format(**FIELDS)}] + history + [current]
+        payload = base_payload(messages)
+        payload["tools"] = TOOLS
+        return json_codec.dumps(payload)
+
+    def preencoded_encode():
+        messages = [template.encode_message("system", **FIELDS)] + history + [current]
+        payload = base_payload(PreEncoded(json_codec.encode_array(messages)))
+        payload["tools"] = tools_encoded
+        return json_codec.encode_object(payload)
+
+    assert json.loads(preencoded_encode()) == json.loads(stdlib_encode())
+    print(f"json_codec backend: {json_codec.BACKEND}, history={args.history}, turns={args.turns:,}")
+    bench("stdlib json (old)", args.turns, stdlib_encode, json.loads, response)
+    bench("json_codec", args.turns, codec_encode, json_codec.loads, response)
+    bench("json_codec + pre-encoded", args.turns, preencoded_encode, json_codec.loads, response)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# benchmarks/listener_replay.py
+# Replays a stream of MESSAGE_CREATE events through AICog.on_message and reports events/second and CPU per
+# event. on_message runs for every message in every channel the bot can see, not just the ones it answers,
+# so its fixed cost (bot-author check, DM/mention detection, mention stripping, channel context) is what
+# matters on busy guilds.
+#
+#   python benchmarks/listener_replay.py                               # 50k synthetic events, unpaced
+#   python benchmarks/listener_replay.py --rate 2000 --events 100000   # paced at 2000 events/s
+#   python benchmarks/listener_replay.py --save stream.jsonl           # keep the synthetic stream
+#   python benchmarks/listener_replay.py --input stream.jsonl --bot-id 1234567890   # replay a recorded one
+#
+# Input lines are MESSAGE_CREATE payloads: the gateway frame's "d" object or the whole {"t": ..., "d": ...}
+# frame (other event types are skipped). Events go through discord.py's own parser, so building the Message
+# is part of the measured path just like live. The listener is also timed on its own. Messages the bot
+# answers run the real reply path: the LLM is benchmarks/stub_llm_server.py in a subprocess, and Discord's
+# REST API (typing, replies) is faked in-process.
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from utils import json_codec
+
+WORDS = "hey lol what is the best song rin len miku concert tonight anyone playing ranked later gg nice oranges".split()
+TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+
+def user_payload(user_id: int, bot: bool = False):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "global_name": f"User {user_id}",
+            "avatar": None, "bot": bot}
+
+
+def synthetic_stream(args):
+    """MESSAGE_CREATE payloads shaped like busy community guilds, with a few DMs, bots and mentions mixed in."""
+    rng = random.Random(args.seed)
+    for i in range(args.events):
+        author_id = 10**6 + rng.randrange(args.users)
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 40)))
+        data = {"id": str(10**12 + i), "author": user_payload(author_id, bot=rng.random() < args.bot_rate),
+                "content": content, "timestamp": TIMESTAMP, "edited_timestamp": None, "tts": False,
+                "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+                "pinned": False, "type": 0, "flags": 0}
+        if rng.random() < args.dm_rate:
+            data["channel_id"] = str(5 * 10**11 + author_id)
+        else:
+            guild_id = 1 + rng.randrange(args.guilds)
+            data["guild_id"] = str(guild_id)
+            data["channel_id"] = str(guild_id * 1000 + 1 + rng.randrange(args.channels))
+            data["member"] = {"roles": [], "joined_at": TIMESTAMP, "deaf": False, "mute": False, "flags": 0, "nick": None}
+            if rng.random() < args.mention_rate:
+                data["content"] = f"<@{args.bot_id}> {content}"
+                data["mentions"] = [user_payload(args.bot_id, bot=True)]
+        yield data
+
+
+def read_stream(path: str):
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            frame = json_codec.loads(line)
+            if "t" in frame:
+                if frame["t"] != "MESSAGE_CREATE":
+                    continue
+                frame = frame["d"]
+            yield frame
+
+
+def guild_payloads(stream):
+    """Minimal GUILD_CREATE payloads for every guild and text channel the stream mentions."""
+    channels = {}
+    for data in stream:
+        if "guild_id" in data:
+            channels.setdefault(data["guild_id"], set()).add(data["channel_id"])
+    for guild_id, channel_ids in channels.items():
+        yield {
+            "id": guild_id, "name": f"Guild {guild_id}", "icon": None, "owner_id": "1", "afk_timeout": 300,
+            "verification_level": 1, "default_message_notifications": 1, "explicit_content_filter": 0,
+            "features": [], "mfa_level": 0, "system_channel_flags": 0, "premium_tier": 0, "preferred_locale": "en-US",
+            "nsfw_level": 0, "large": True, "unavailable": False, "member_count": 1000, "joined_at": TIMESTAMP,
+            "roles": [{"id": guild_id, "name": "@everyone", "permissions": "1071698660929", "position": 0, "color": 0,
+                       "hoist": False, "managed": False, "mentionable": False, "flags": 0}],
+            "channels": [{"id": channel_id, "type": 0, "name": f"channel-{channel_id}", "position": n,
+                          "permission_overwrites": [], "nsfw": False, "parent_id": None}
+                         for n, channel_id in enumerate(sorted(channel_ids))],
+            "members": [], "voice_states": [], "presences": [], "emojis": [], "stickers": [], "threads": [],
+            "stage_instances": [], "guild_scheduled_events": [], "soundboard_sounds": [],
+        }
+
+
+def fake_discord_rest(bot, bot_id: int) -> Counter:
+    """Answers the REST calls the reply path makes (typing, send message) without a network."""
+    calls = Counter()
+    ids = itertools.count(2 * 10**12)
+
+    async def request(route, **kwargs):
+        calls[f"{route.method} {route.path}"] += 1
+        if route.method == "POST" and route.path.endswith("/messages"):
+            payload = kwargs.get("json") or {}
+            return {"id": str(next(ids)), "channel_id": str(route.channel_id), "author": user_payload(bot_id, bot=True),
+                    "content": payload.get("content", ""), "timestamp": TIMESTAMP, "edited_timestamp": None,
+                    "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+                    "embeds": [], "pinned": False, "type": 19, "flags": 0}
+        return None
+
+    bot.http.request = request
+    return calls
+
+
+async def replay(args, stream):
+    from discord.ext import commands
+    from cogs.ai import AICog
+    from utils.cache_profile import build_client_options
+
+    bot = commands.Bot(command_prefix="/", **build_client_options(args.profile))
+    async with bot: # Sets up the client's loop without logging in
+        state = bot._connection
+        state.parsers["READY"]({"v": 10, "user": user_payload(args.bot_id, bot=True), "guilds": [], "session_id": "bench",
+                                "resume_gateway_url": "wss://localhost", "application": {"id": str(args.bot_id), "flags": 0}})
+        for payload in guild_payloads(stream):
+            state.parsers["GUILD_CREATE"](payload)
+        if state._ready_task is not None:
+            state._ready_task.cancel()
+        rest_calls = fake_discord_rest(bot, args.bot_id)
+
+        cog = AICog(bot)
+        listener = cog.on_message
+        listener_ns = []
+
+        async def timed_on_message(message):
+            started = time.perf_counter_ns()
+            await listener(message) # Never suspends: replies run in their own tasks
+            listener_ns.append(time.perf_counter_ns() - started)
+
+        cog.on_message = timed_on_message # Picked up by add_cog in place of the class's listener
+        await bot.add_cog(cog)
+
+        parse = state.parsers["MESSAGE_CREATE"]
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        max_behind = 0.0
+        for i, data in enumerate(stream):
+            if args.rate:
+                delay = started + i / args.rate - time.perf_counter()
+                if delay > 0.001:
+                    await asyncio.sleep(delay)
+                else:
+                    max_behind = max(max_behind, -delay)
+                    if i % 100 == 0:
+                        await asyncio.sleep(0)
+            elif i % 100 == 0:
+                await asyncio.sleep(0) # Let the dispatched listener tasks run
+            parse(data)
+        while len(listener_ns) < len(stream):
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        # Wait for the replies still debouncing / generating, then shut the cog down
+        deadline = time.monotonic() + args.debounce + args.llm_latency + 30
+        while cog.inflight_generations and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await bot.remove_cog(cog.qualified_name)
+
+    ordered = sorted(listener_ns)
+    pct = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] / 1000
+    events = len(stream)
+    print(f"profile={args.profile} channel_context={'on' if args.channel_context else 'off'} "
+          f"rate={'unpaced' if not args.rate else f'{args.rate:,}/s'}")
+    print(f"  events      {events:,} in {elapsed:.2f}s = {events / elapsed:,.0f} events/s"
+          + (f" (fell behind schedule by up to {max_behind * 1000:.0f} ms)" if args.rate else ""))
+    print(f"  CPU/event   {cpu / events * 1e6:.1f} us total (parse + dispatch + listener + replies)")
+    print(f"  on_message  mean {statistics.mean(ordered) / 1000:.1f} us  p50 {pct(0.5):.1f} us  p99 {pct(0.99):.1f} us  max {ordered[-1] / 1000:.1f} us")
+    print(f"  replies     {rest_calls.get('POST /channels/{channel_id}/messages', 0):,} sent, "
+          f"{cog.coalesced_messages:,} messages coalesced, {len(cog.inflight_generations):,} still in flight")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay MESSAGE_CREATE events through AICog.on_message.")
+    parser.add_argument("--input", help="JSONL stream to replay (default: synthetic)")
+    parser.add_argument("--save", help="Write the synthetic stream to this JSONL file")
+    parser.add_argument("--events", type=int, default=50_000)
+    parser.add_argument("--rate", type=int, default=0, help="Events per second (0 = as fast as possible)")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=20, help="Text channels per guild")
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--mention-rate", type=float, default=0.01, help="Share of guild messages mentioning the bot")
+    parser.add_argument("--dm-rate", type=float, default=0.005)
+    parser.add_argument("--bot-rate", type=float, default=0.05, help="Share of messages from other bots")
+    parser.add_argument("--bot-id", type=int, default=100, help="The bot's user id (match the recorded stream's mentions)")
+    parser.add_argument("--profile", default="lean", choices=["default", "lean"], help="Cache profile (utils/cache_profile.py)")
+    parser.add_argument("--channel-context", action="store_true", help="Run with AI_CHANNEL_CONTEXT=1")
+    parser.add_argument("--debounce", type=float, default=1.0, help="AI_DEBOUNCE_SECONDS")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-port", type=int, default=9151)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    stream = list(read_stream(args.input) if args.input else synthetic_stream(args))
+    if args.save:
+        with open(args.save, "wb") as f:
+            for data in stream:
+                f.write(json_codec.dumps({"t": "MESSAGE_CREATE", "d": data}) + b"\n")
+
+    workdir = tempfile.mkdtemp(prefix="listener_replay_")
+    os.chdir(workdir) # The cog's JSON files land here
+    os.environ.update({
+        "AI_API_KEY": "bench",
+        "AI_API_ENDPOINTS": f"http://127.0.0.1:{args.llm_port}/v1/chat/completions",
+        "BOT_MEMORY_PATH": os.path.join(workdir, "mind.json"),
+        "BOT_SNAPSHOT_PATH": "",
+        "AI_DEBOUNCE_SECONDS": str(args.debounce),
+        "AI_CHANNEL_CONTEXT": "1" if args.channel_context else "0",
+    })
+    stub = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "stub_llm_server.py"),
+                             f"{args.llm_port}:{args.llm_latency}"], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1.0) # Let the stub bind its port
+        asyncio.run(replay(args, stream))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    main()
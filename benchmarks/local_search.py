@@ -0,0 +1,100 @@
+# benchmarks/local_search.py
+# The local search backend behind search_internet (utils/local_search.py): time to index a documents
+# directory from scratch, to re-sync it after a few files change (the periodic sync), and per-query
+# latency from SQLite versus the LRU cache.
+#
+#   python benchmarks/local_search.py                       # 1k and 10k documents
+#   python benchmarks/local_search.py --docs 50000 --changed 100
+#
+# Documents are synthetic markdown files of a few paragraphs, with a heading, drawn from a vocabulary
+# large enough that queries match some but not all of them.
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VOCABULARY = [f"{a}{b}" for a in ("ka", "ri", "le", "mi", "ku", "to", "ne", "so", "ha", "yu", "ro", "pi")
+              for b in ("n", "ta", "ko", "ra", "me", "shi", "to", "ya", "no", "ru", "ki", "sa")]
+COMMON = "the song concert stage album live tour release vocal piano guitar remix cover".split()
+
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(rng.choice(COMMON) if rng.random() < 0.4 else rng.choice(VOCABULARY) for _ in range(rng.randint(40, 120))) + "."
+
+
+def write_doc(path: str, rng: random.Random, number: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {rng.choice(VOCABULARY)} {rng.choice(COMMON)} {number}\n\n")
+        f.write("\n\n".join(paragraph(rng) for _ in range(rng.randint(2, 8))))
+
+
+def percentile(ordered, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(docs: int, changed: int, queries: int):
+    from utils.local_search import LocalSearch
+    workdir = tempfile.mkdtemp(prefix="local_search_")
+    try:
+        docs_dir = os.path.join(workdir, "docs")
+        os.makedirs(docs_dir)
+        rng = random.Random(docs)
+        for i in range(docs):
+            write_doc(os.path.join(docs_dir, f"doc_{i:06d}.md"), rng, i)
+        corpus_bytes = sum(os.path.getsize(os.path.join(docs_dir, name)) for name in os.listdir(docs_dir))
+
+        search = LocalSearch(os.path.join(workdir, "index.db"), docs_dir)
+        started = time.perf_counter()
+        search.sync()
+        full = time.perf_counter() - started
+
+        started = time.perf_counter()
+        search.sync()
+        unchanged = time.perf_counter() - started
+
+        for i in rng.sample(range(docs), changed):
+            write_doc(os.path.join(docs_dir, f"doc_{i:06d}.md"), rng, i)
+        os.remove(os.path.join(docs_dir, "doc_000000.md"))
+        started = time.perf_counter()
+        counts = search.sync()
+        incremental = time.perf_counter() - started
+
+        query_list = [" ".join(rng.sample(VOCABULARY, rng.randint(1, 3))) for _ in range(queries)]
+        cold, warm, hits = [], [], 0
+        for query in query_list:
+            started = time.perf_counter()
+            hits += bool(search.search(query))
+            cold.append(time.perf_counter() - started)
+        for query in query_list:
+            started = time.perf_counter()
+            search.cached(query, 3)
+            warm.append(time.perf_counter() - started)
+        cold.sort()
+        warm.sort()
+        search.close()
+
+        print(f"docs={docs:>7,} ({corpus_bytes / 1e6:.1f} MB, {search.stats['passages']:,} passages)  index {full:6.2f} s   "
+              f"re-sync unchanged {unchanged * 1000:6.1f} ms, {counts['updated']} changed + {counts['removed']} removed {incremental * 1000:6.1f} ms")
+        print(f"    query p50 {percentile(cold, 0.5) * 1000:6.2f} ms  p99 {percentile(cold, 0.99) * 1000:6.2f} ms  "
+              f"({hits}/{queries} with results)   cached p50 {percentile(warm, 0.5) * 1e6:5.1f} us")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local full-text search: indexing and query latency.")
+    parser.add_argument("--docs", type=int, nargs="+", default=[1_000, 10_000])
+    parser.add_argument("--changed", type=int, default=20, help="Files rewritten before the incremental sync.")
+    parser.add_argument("--queries", type=int, default=300)
+    args = parser.parse_args()
+    for docs in args.docs:
+        run(docs, args.changed, args.queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# benchmarks/prompt_prefix.py
+# Measures how much of each LLM request is a prefix shared with other requests, i.e. what a
+# provider-side prompt cache could reuse. Feed it request bodies sampled by the AI cog:
+#
+#   AI_PROMPT_SAMPLE_PATH=prompts_stable.jsonl AI_PROMPT_SAMPLE_RATE=1 python bot.py   # then chat a while
+#   AI_PROMPT_LAYOUT=legacy AI_PROMPT_SAMPLE_PATH=prompts_legacy.jsonl ...               # for comparison
+#   python benchmarks/prompt_prefix.py prompts_legacy.jsonl prompts_stable.jsonl
+#
+# Each request is rendered the way a chat template sees it (tools first, then role/content of every
+# message), so JSON key order and escaping don't affect the numbers. For every request the "cacheable
+# prefix" is its longest common prefix with any other request in the same sample (usually the same
+# user's previous turn); the random-pair figure is closer to what one user's request shares with another's.
+import argparse
+import os
+import random
+import statistics
+import sys
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import json_codec
+
+
+def render(request: dict) -> str:
+    parts = [json_codec.dumps_str(request.get("tools") or [])]
+    for message in request.get("messages", []):
+        parts.append(f"<|{message.get('role')}|>\n{message.get('content') or ''}")
+    return "\n".join(parts)
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    limit = min(len(a), len(b))
+    if a[:limit] == b[:limit]:
+        return limit
+    low, high = 0, limit # Binary search on slice equality is much faster than a per-char loop
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def cacheable_prefixes(prompts: List[str]) -> List[int]:
+    """Longest common prefix of each prompt with any other prompt (neighbours in sorted order suffice)."""
+    order = sorted(range(len(prompts)), key=prompts.__getitem__)
+    best = [0] * len(prompts)
+    for left, right in zip(order, order[1:]):
+        shared = common_prefix_length(prompts[left], prompts[right])
+        best[left] = max(best[left], shared)
+        best[right] = max(best[right], shared)
+    return best
+
+
+def load_prompts(path: str) -> List[str]:
+    prompts = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                prompts.append(render(json_codec.loads(line)))
+    return prompts
+
+
+def random_pair_prefixes(prompts: List[str], pairs: int = 2000) -> List[int]:
+    rng = random.Random(0)
+    return [common_prefix_length(*rng.sample(prompts, 2)) for _ in range(pairs)]
+
+
+def report(path: str):
+    prompts = load_prompts(path)
+    if len(prompts) < 2:
+        print(f"{path}: need at least two sampled requests, found {len(prompts)}")
+        return
+    shared = cacheable_prefixes(prompts)
+    total = sum(len(p) for p in prompts)
+    common_to_all = min(common_prefix_length(prompts[0], p) for p in prompts[1:])
+    print(f"{path}: {len(prompts):,} requests, avg prompt {total / len(prompts):,.0f} chars")
+    print(f"  prefix common to every request:  {common_to_all:,} chars")
+    print(f"  cacheable prefix per request:    median {statistics.median(shared):,.0f}  mean {statistics.mean(shared):,.0f}  min {min(shared):,} chars")
+    print(f"  shared with a random request:    median {statistics.median(random_pair_prefixes(prompts)):,.0f} chars")
+    print(f"  share of prompt chars cacheable: {sum(shared) / total:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-prefix length across sampled LLM requests.")
+    parser.add_argument("samples", nargs="+", help="JSONL files written via AI_PROMPT_SAMPLE_PATH.")
+    args = parser.parse_args()
+    for path in args.samples:
+        report(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# benchmarks/startup_state.py
+# Time to get the AI cog's persisted state into memory at startup: parsing the JSON files (what
+# AICog.__init__ did before) versus loading the binary snapshot from utils/state_snapshot.py.
+# Both paths build the same objects the cog keeps (HistoryBuffer rings, fact lists, config dicts), and
+# each is timed with the cyclic GC running and paused (the cog pauses it while loading).
+#
+#   python benchmarks/startup_state.py                       # 10k and 50k users
+#   python benchmarks/startup_state.py --users 200000 --no-orjson
+#
+# Data is synthetic but sized like a busy bot: 20 history messages of ~150 characters per user,
+# ~6 remembered facts, config overrides for one user in ten, and a few hundred context entries.
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = "rin len miku oranges bananas concert piano leek road roller stage song twin mirror ribbon".split()
+FILES = ("memory", "history", "manual_context", "dynamic_learning", "configs", "guild_configs")
+
+
+def sentence(rng: random.Random, length: int) -> str:
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def make_state(users: int, messages: int, seed: int = 1):
+    rng = random.Random(seed)
+    memory, history, configs = {}, {}, {}
+    for u in range(users):
+        user_id = str(100000000000000000 + u)
+        memory[user_id] = [sentence(rng, 30) for _ in range(rng.randint(2, 10))]
+        history[user_id] = [{"role": "user" if m % 2 == 0 else "assistant", "content": sentence(rng, 150)}
+                            for m in range(messages)]
+        if u % 10 == 0:
+            configs[user_id] = {"temperature": round(rng.uniform(0.2, 1.2), 2), "max_tokens": 1000}
+    return {
+        "memory": memory,
+        "history": history,
+        "manual_context": [sentence(rng, 120) for _ in range(200)],
+        "dynamic_learning": [sentence(rng, 200) for _ in range(300)],
+        "configs": configs,
+        "guild_configs": {str(900000000000000000 + g): {"model": "Llama-3.3-70B-Instruct"} for g in range(100)},
+    }
+
+
+def load_json(paths, capacity: int):
+    from utils import json_codec
+    from utils.history import HistoryBuffer
+    loaded = {}
+    for name in FILES:
+        with open(paths[name], "r", encoding="utf-8") as f:
+            loaded[name] = json_codec.load(f)
+    loaded["history"] = {user_id: HistoryBuffer.from_api(messages, capacity) for user_id, messages in loaded["history"].items()}
+    return loaded
+
+
+def load_snapshot(path: str, paths, capacity: int):
+    from utils import state_snapshot
+    from utils.history import HistoryBuffer
+    state = state_snapshot.load(path, list(paths.values()))
+    state["history"] = {user_id: HistoryBuffer.from_record(record, capacity) for user_id, record in state["history"].items()}
+    return state
+
+
+def best_of(repeat: int, fn, gc_paused: bool):
+    from utils.state_snapshot import gc_paused as paused
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        if gc_paused:
+            with paused(): # As AICog.__init__ loads
+                result = fn()
+        else:
+            result = fn()
+        times.append(time.perf_counter() - started)
+        del result
+    return min(times)
+
+
+def run(users: int, messages: int, repeat: int):
+    from utils import json_codec, state_snapshot
+    workdir = tempfile.mkdtemp(prefix="startup_state_")
+    try:
+        state = make_state(users, messages)
+        paths = {name: os.path.join(workdir, f"{name}.json") for name in FILES}
+        for name in FILES:
+            with open(paths[name], "w", encoding="utf-8") as f:
+                json_codec.dump(state[name], f) # Same indented format the cog writes
+        json_bytes = sum(os.path.getsize(p) for p in paths.values())
+
+        # Snapshot exactly as AICog.write_snapshot builds it
+        loaded = load_json(paths, messages)
+        started = time.perf_counter()
+        data = state_snapshot.encode({
+            "memory": loaded["memory"],
+            "history": {user_id: buffer.to_record() for user_id, buffer in loaded["history"].items()},
+            "manual_context": loaded["manual_context"],
+            "dynamic_learning": loaded["dynamic_learning"],
+            "user_configs": loaded["configs"],
+            "guild_configs": loaded["guild_configs"],
+        }, list(paths.values()))
+        encode_time = time.perf_counter() - started
+        snapshot_path = os.path.join(workdir, "state.bin")
+        state_snapshot.write(snapshot_path, data)
+        del loaded, state
+
+        print(f"users={users:>8,}  json files {json_bytes / 1e6:.1f} MB, snapshot {len(data) / 1e6:.1f} MB (encode {encode_time * 1000:.0f} ms)")
+        for gc_paused in (False, True):
+            json_time = best_of(repeat, lambda: load_json(paths, messages), gc_paused)
+            snapshot_time = best_of(repeat, lambda: load_snapshot(snapshot_path, paths, messages), gc_paused)
+            print(f"    gc {'paused ' if gc_paused else 'enabled'}  json {json_time * 1000:7.0f} ms   "
+                  f"snapshot {snapshot_time * 1000:7.0f} ms   x{json_time / snapshot_time:.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup state load: JSON files vs binary snapshot.")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 50_000])
+    parser.add_argument("--messages", type=int, default=20, help="History messages per user (= max_history_messages).")
+    parser.add_argument("--repeat", type=int, default=3, help="Loads per path; the best time is reported.")
+    parser.add_argument("--no-orjson", action="store_true", help="Make json_codec use its stdlib fallback.")
+    args = parser.parse_args()
+    if args.no_orjson:
+        sys.modules["orjson"] = None # Makes `import orjson` raise ImportError
+    from utils import json_codec
+    print(f"json backend: {json_codec.BACKEND}")
+    for users in args.users:
+        run(users, args.messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# benchmarks/stub_llm_server.py
+# Local OpenAI-compatible /v1/chat/completions stubs with configurable latency profiles, for trying
+# out multi-endpoint routing (AI_API_ENDPOINTS) without a real provider.
+#
+#   python benchmarks/stub_llm_server.py 9001:0.3 9002:0.8:0.2 9003:0.3:0.05:0.2:0.1:8
+#   AI_API_ENDPOINTS=http://127.0.0.1:9001/v1/chat/completions,http://127.0.0.1:9002/v1/chat/completions python bot.py
+#
+# Each spec is port:latency[:jitter[:error_rate[:slow_rate[:slow_latency]]]] (seconds / fractions):
+# requests take latency +/- jitter, error_rate of them answer HTTP 500, and slow_rate of them stall
+# for slow_latency instead (the tail that hedging is meant to cut).
+import argparse
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class Profile:
+    port: int
+    latency: float
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency: float = 10.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Profile":
+        parts = spec.split(":")
+        return cls(int(parts[0]), *(float(p) for p in parts[1:]))
+
+
+def make_app(profile: Profile, seed: int = 0) -> web.Application:
+    rng = random.Random(seed or profile.port)
+    counters = {"requests": 0, "errors": 0, "slow": 0}
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        payload = await request.json()
+        counters["requests"] += 1
+        roll = rng.random()
+        if roll < profile.error_rate:
+            counters["errors"] += 1
+            await asyncio.sleep(profile.latency / 4)
+            return web.json_response({"error": {"message": "stub upstream error"}}, status=500)
+        if roll < profile.error_rate + profile.slow_rate:
+            counters["slow"] += 1
+            delay = profile.slow_latency
+        else:
+            delay = max(0.0, profile.latency + rng.uniform(-profile.jitter, profile.jitter))
+        await asyncio.sleep(delay)
+        last = payload.get("messages", [{}])[-1].get("content", "")
+        content = f"Stub {profile.port} says hi! You said: {str(last)[:100]}"
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in payload.get("messages", [])) // 4 + 1 # ~4 chars/token
+        completion_tokens = len(content) // 4 + 1
+        return web.json_response({
+            "id": f"stub-{profile.port}-{counters['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    app = web.Application()
+    app["counters"] = counters
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+async def start_stubs(profiles, host: str = "127.0.0.1"):
+    """Starts one stub per profile on the running loop. Returns the runners (call .cleanup() to stop)."""
+    runners = []
+    for profile in profiles:
+        runner = web.AppRunner(make_app(profile), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, profile.port).start()
+        runners.append(runner)
+    return runners
+
+
+async def _serve(profiles, host: str):
+    await start_stubs(profiles, host)
+    for p in profiles:
+        print(f"stub on http://{host}:{p.port}/v1/chat/completions latency={p.latency}s jitter={p.jitter}s "
+              f"errors={p.error_rate:.0%} slow={p.slow_rate:.0%}@{p.slow_latency}s")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub servers.")
+    parser.add_argument("specs", nargs="+", help="port:latency[:jitter[:error_rate[:slow_rate[:slow_latency]]]]")
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve([Profile.parse(s) for s in args.specs], args.host))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
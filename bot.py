@@ -1,9 +1,12 @@
 import os
+import time
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 import asyncio
 from discord import app_commands
+from utils.shared_store import open_shared_store
+from utils.cache_profile import build_client_options
 
 # Load environment variables
 load_dotenv("/home/server/rinandlen.env")
@@ -13,11 +16,26 @@ discord_token = os.getenv("DISCORD_TOKEN")
 if not discord_token:
     raise ValueError("Missing DISCORD_TOKEN environment variable.")
 
-# Configure bot with intents
-intents = discord.Intents.default()
-intents.message_content = True
+# Configure bot with intents and caches (BOT_CACHE_PROFILE=lean trims both for large deployments)
+cache_profile = os.getenv("BOT_CACHE_PROFILE", "default")
+client_options = build_client_options(cache_profile)
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+# --- Sharding / Clustering ---
+# launcher.py sets these for each cluster process. Run bot.py directly for the old single-process bot,
+# or set BOT_AUTO_SHARD=1 to let discord.py pick the shard count for a single process.
+shard_count = int(os.getenv("BOT_SHARD_COUNT", "0")) or None
+shard_ids = [int(s) for s in os.getenv("BOT_SHARD_IDS", "").split(",") if s.strip()] or None
+cluster_id = int(os.getenv("BOT_CLUSTER_ID", "0"))
+health_interval = float(os.getenv("BOT_HEALTH_INTERVAL", "15"))
+
+if shard_count or os.getenv("BOT_AUTO_SHARD") == "1":
+    bot = commands.AutoShardedBot(command_prefix="/", shard_count=shard_count, shard_ids=shard_ids, **client_options)
+else:
+    bot = commands.Bot(command_prefix="/", **client_options)
+
+# Clusters report health through the same store the AI state lives in (if configured)
+health_store = open_shared_store()
+# -----------------------------
 
 # Load cog files dynamically
 async def load_cogs():
@@ -29,14 +47,40 @@ async def load_cogs():
             except Exception as e:
                 print(f"Failed to load cog {filename}: {e}")
 
-@bot.event
-async def on_ready():
+@tasks.loop(seconds=health_interval)
+async def report_cluster_health():
+    """Writes this cluster's shard latencies and guild count to the shared store for launcher.py."""
+    if isinstance(bot, commands.AutoShardedBot):
+        latencies = {str(shard_id): round(latency * 1000, 1) for shard_id, latency in bot.latencies}
+    else:
+        latencies = {"0": round(bot.latency * 1000, 1)}
+    health = {
+        "cluster_id": cluster_id,
+        "pid": os.getpid(),
+        "shard_ids": shard_ids or [int(s) for s in latencies],
+        "shard_count": bot.shard_count or 1,
+        "latency_ms": latencies,
+        "guilds": len(bot.guilds),
+        "ready": bot.is_ready(),
+        "reported_at": time.time(),
+    }
     try:
-        await bot.tree.sync()  # Sync commands globally or specify a guild if needed
-        print("Commands synced successfully!")
+        health_store.set("cluster_health", str(cluster_id), health)
     except Exception as e:
-        print(f"Failed to sync commands: {e}")
-    print(f"Logged in as {bot.user}")
+        print(f"Failed to report cluster health: {e}")
+
+@bot.event
+async def on_ready():
+    # Only the first cluster syncs the command tree; the others would just repeat the same request
+    if cluster_id == 0:
+        try:
+            await bot.tree.sync()  # Sync commands globally or specify a guild if needed
+            print("Commands synced successfully!")
+        except Exception as e:
+            print(f"Failed to sync commands: {e}")
+    if health_store and not report_cluster_health.is_running():
+        report_cluster_health.start()
+    print(f"Logged in as {bot.user} (cluster {cluster_id}, shards {shard_ids or 'all'})")
 
 async def main():
     async with bot:
@@ -5,15 +5,23 @@ import psutil
 import discord
 from discord.ext import commands
 from discord import app_commands
-import shutil
-import subprocess
+import importlib
 import sys
 import asyncio
 import logging
+from utils import hot_update
+
+# /update pulls into a staging checkout next to the live one and copies changed files over (see utils/hot_update.py)
+UPDATE_LIVE_DIR = os.getenv("BOT_UPDATE_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UPDATE_STAGING_DIR = os.getenv("BOT_UPDATE_STAGING_DIR", UPDATE_LIVE_DIR.rstrip("/") + ".staging")
+UPDATE_BACKUP_DIR = os.getenv("BOT_UPDATE_BACKUP_DIR", UPDATE_LIVE_DIR.rstrip("/") + ".update-backup")
+UPDATE_REPO_URL = os.getenv("BOT_UPDATE_REPO", "https://github.com/learnhelp-cc/rin-and-lenai.git")
+UPDATE_BRANCH = os.getenv("BOT_UPDATE_BRANCH") # Remote default branch if unset
 
 class Core(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.update_lock = asyncio.Lock()
 
     @app_commands.command(name="sysinfo", description="Shows the hardware information of the server.")
     async def sysinfo(self, interaction: discord.Interaction):
@@ -102,33 +110,112 @@ class Core(commands.Cog):
         embed.set_footer(text="Thank you for using the bot!")
         await interaction.response.send_message(embed=embed)
 
-    @app_commands.command(name="update", description="Updates the bot code from GitLab and restarts the bot. (Admin Only)")
-    async def update(self, interaction: discord.Interaction):
+    @app_commands.command(name="update", description="Pulls the latest code and reloads the changed cogs in place. (Admin Only)")
+    @app_commands.describe(restart="Also restart the bot if files that can't be reloaded in place (like bot.py) changed")
+    async def update(self, interaction: discord.Interaction, restart: bool = False):
         if not interaction.user.guild_permissions.administrator:
             await interaction.response.send_message("You do not have permission to run this command.", ephemeral=True)
             return
-        await interaction.response.send_message("Initiating update. The bot will restart shortly...")
-        target_dir = "/home/server/rin-and-lenai/"
-        repo_url = "https://github.com/learnhelp-cc/rin-and-lenai.git"
-        restart_script = "/home/server/rin-and-lenai/bot.py"
+        if self.update_lock.locked():
+            await interaction.response.send_message("An update is already running.", ephemeral=True)
+            return
+        await interaction.response.send_message("Fetching the latest code...")
+        async with self.update_lock:
+            try:
+                reloaded, needs_restart = await self.apply_update(interaction)
+            except Exception as e:
+                error_msg = f"Update failed: {e}"
+                print(error_msg)
+                await interaction.followup.send(error_msg[:1900])
+                return
+        if needs_restart:
+            if restart:
+                await interaction.followup.send(f"Restarting for: {', '.join(needs_restart)}")
+                for cog in self.bot.cogs.values():
+                    if hasattr(cog, "write_snapshot"):
+                        cog.write_snapshot(force=True) # execv skips cog_unload, which normally writes it
+                os.execv(sys.executable, [sys.executable, os.path.join(UPDATE_LIVE_DIR, "bot.py")])
+            await interaction.followup.send(f"These changes take effect on the next restart: {', '.join(needs_restart)}")
+        if reloaded:
+            await interaction.followup.send(f"Reloaded in place: {', '.join(reloaded)}")
+
+    async def apply_update(self, interaction: discord.Interaction):
+        """Fetches into the staging checkout, validates it, copies the changed files into the live tree and
+        reloads the affected extensions. Returns (reloaded extensions, changed files that need a restart)."""
+        revision = await hot_update.fetch_staging(UPDATE_REPO_URL, UPDATE_STAGING_DIR, UPDATE_BRANCH)
+        changed = await hot_update.changed_files(UPDATE_STAGING_DIR, UPDATE_LIVE_DIR)
+        if not changed:
+            await interaction.followup.send(f"Already up to date (`{revision[:10]}`).")
+            return [], []
+        cogs_dir = os.path.join(UPDATE_STAGING_DIR, "cogs")
+        all_cogs = [f"cogs.{f[:-3]}" for f in sorted(os.listdir(cogs_dir)) if f.endswith(".py")] if os.path.isdir(cogs_dir) else []
+        await hot_update.validate(UPDATE_STAGING_DIR, all_cogs)
+        await interaction.followup.send(f"`{revision[:10]}` compiles and imports cleanly; applying {len(changed)} changed file(s)...")
+
+        changed_modules = [hot_update.module_name(path) for path in changed]
+        changed_cogs = [m for m in changed_modules if m and m.startswith("cogs.") and m.count(".") == 1]
+        changed_utils = [m for m in changed_modules if m and m.startswith("utils.") and m in sys.modules]
+        # Top-level scripts (bot.py, launcher.py) only run at startup; benchmarks never run inside the bot
+        needs_restart = [path for path in changed if path.endswith(".py") and "/" not in path]
+        if changed_utils:
+            # Cogs hold references into utils modules, so every loaded cog is reloaded after them
+            targets = sorted(set(changed_cogs) | {ext for ext in self.bot.extensions if ext.startswith("cogs.")})
+        else:
+            targets = sorted(changed_cogs)
+        targets.sort(key=lambda ext: ext == "cogs.core") # This cog (running the update) goes last
 
+        manifest = await asyncio.to_thread(hot_update.apply_files, UPDATE_STAGING_DIR, UPDATE_LIVE_DIR, changed, UPDATE_BACKUP_DIR)
+        attempted = []
         try:
-            if os.path.exists(target_dir):
-                shutil.rmtree(target_dir)
-                await interaction.followup.send(f"Removed directory: {target_dir}")
-            else:
-                await interaction.followup.send(f"Directory {target_dir} does not exist; proceeding with clone...")
-            subprocess.run(["git", "clone", repo_url, target_dir], check=True)
-            await interaction.followup.send("Repository cloned successfully.")
+            await self.reload_modules(changed_utils, targets, attempted)
         except Exception as e:
-            error_msg = f"Update failed: {e}"
-            print(error_msg)
-            await interaction.followup.send(error_msg)
-            return
-        os.execv(sys.executable, [sys.executable, restart_script])
-        await interaction.response.send_message("Bot has updated to the latest commit and is restarting...")
+            print(f"Reload failed, rolling back: {e}")
+            await asyncio.to_thread(hot_update.restore_files, UPDATE_LIVE_DIR, manifest)
+            try:
+                await self.reload_modules(changed_utils, attempted, [])
+            except Exception as rollback_error:
+                print(f"Rollback reload failed: {rollback_error}")
+                raise hot_update.UpdateError(f"reload failed ({e}) and so did the rollback ({rollback_error}); restart the bot") from e
+            raise hot_update.UpdateError(f"reload failed, rolled back to the previous code: {e}") from e
+
+        if targets:
+            try:
+                await self.bot.tree.sync() # Pick up added/changed app commands
+            except Exception as e:
+                print(f"Failed to sync commands after update: {e}")
+        return targets, needs_restart
+
+    async def reload_modules(self, utils_modules, extensions, attempted):
+        """Reloads utils modules, then extensions (appending each one to `attempted` before trying it).
+
+        Cogs that can hand their live state to their replacement (`export_state`) do so through
+        bot.cog_state_handoff; whatever nobody adopted is released afterwards.
+        """
+        importlib.invalidate_caches() # New files must be visible to the import system
+        for name in utils_modules:
+            importlib.reload(sys.modules[name])
+        for ext in extensions:
+            handoffs = {}
+            for cog in list(self.bot.cogs.values()):
+                if cog.__module__ == ext and hasattr(cog, "export_state"):
+                    handoffs[cog.qualified_name] = (cog, cog.export_state())
+            self.bot.cog_state_handoff = {name: state for name, (cog, state) in handoffs.items()}
+            attempted.append(ext)
+            try:
+                if not os.path.exists(os.path.join(UPDATE_LIVE_DIR, *ext.split(".")) + ".py"):
+                    if ext in self.bot.extensions:
+                        await self.bot.unload_extension(ext) # Rolling back a cog the update added
+                elif ext in self.bot.extensions:
+                    # On failure discord.py puts the old module back (which adopts the handoff) and re-raises
+                    await self.bot.reload_extension(ext)
+                else:
+                    await self.bot.load_extension(ext)
+            finally:
+                self.bot.cog_state_handoff = {}
+                for cog, state in handoffs.values():
+                    if not state.get("adopted"):
+                        await cog.release_state(state)
 
-        
     @app_commands.command(name="temps", description="Runs the 'sensors' command and sends its output to chat.")
     async def temps(self, interaction: discord.Interaction):
         """Executes the sensors command and returns the output."""
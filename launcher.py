@@ -0,0 +1,207 @@
+# launcher.py
+# Runs the bot as several shard clusters, one process per cluster, so gateway traffic and AI turns
+# are spread across cores. Every cluster shares AI state through the SQLite store at
+# BOT_SHARED_STORE_PATH and reports its health there; this process watches that health,
+# restarts clusters that die or stop reporting, and prints a status table.
+#
+#   python launcher.py --clusters 4               # real bot, shard count recommended by Discord
+#   python launcher.py --clusters 4 --shards 16   # fixed shard count
+#   python launcher.py --clusters 3 --mock --duration 30   # local test, no Discord connection
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+from utils.shared_store import SharedStore
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORE_PATH = "/home/server/neruaibot/cluster_state.db"
+
+
+def recommended_shard_count(token: str) -> int:
+    """Asks Discord how many shards it recommends for this bot."""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "rin-and-len-launcher"},
+    )
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return int(json.load(response)["shards"])
+
+
+def assign_shards(total_shards: int, clusters: int):
+    """Splits shard IDs into contiguous, evenly sized blocks, one per cluster."""
+    per_cluster, extra = divmod(total_shards, clusters)
+    assignments, start = [], 0
+    for cluster_id in range(clusters):
+        size = per_cluster + (1 if cluster_id < extra else 0)
+        assignments.append(list(range(start, start + size)))
+        start += size
+    return assignments
+
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids, shard_count: int, store_path: str, mock: bool):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.store_path = store_path
+        self.mock = mock
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+    def start(self):
+        env = os.environ.copy()
+        env.update({
+            "BOT_CLUSTER_ID": str(self.cluster_id),
+            "BOT_SHARD_IDS": ",".join(str(s) for s in self.shard_ids),
+            "BOT_SHARD_COUNT": str(self.shard_count),
+            "BOT_SHARED_STORE_PATH": self.store_path,
+        })
+        if self.mock:
+            command = [sys.executable, "-m", "utils.mock_gateway"]
+        else:
+            command = [sys.executable, os.path.join(BOT_DIR, "bot.py")]
+        self.process = subprocess.Popen(command, cwd=BOT_DIR, env=env)
+        self.started_at = time.time()
+        print(f"Started cluster {self.cluster_id} (pid {self.process.pid}) with shards {self.shard_ids}")
+
+    def stop(self, timeout: float = 10.0):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+
+def print_health(store: SharedStore, clusters, stale_after: float):
+    health = store.items_with_age("cluster_health")
+    print(f"--- Cluster health ({time.strftime('%H:%M:%S')}) ---")
+    for cluster in clusters:
+        report, age = health.get(str(cluster.cluster_id), (None, None))
+        if report is None:
+            print(f"cluster {cluster.cluster_id}: no report yet (alive={cluster.is_alive()})")
+            continue
+        latencies = list(report.get("latency_ms", {}).values())
+        avg_latency = sum(latencies) / len(latencies) if latencies else float("nan")
+        if not cluster.is_alive():
+            state = "stopped"
+        elif age > stale_after:
+            state = "STALE"
+        else:
+            state = "ready" if report.get("ready") else "starting"
+        print(
+            f"cluster {cluster.cluster_id}: {state:8} pid={report.get('pid')} shards={report.get('shard_ids')} "
+            f"guilds={report.get('guilds')} avg_latency={avg_latency:.1f}ms max_latency={max(latencies, default=0):.1f}ms "
+            f"last_report={age:.1f}s ago restarts={cluster.restarts}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as multiple shard clusters.")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1, help="Number of cluster processes.")
+    parser.add_argument("--shards", type=int, default=0, help="Total shard count (default: Discord's recommendation).")
+    parser.add_argument("--store", help="Shared SQLite store path (default: BOT_SHARED_STORE_PATH, or a throwaway one with --mock).")
+    parser.add_argument("--mock", action="store_true", help="Run mock clusters instead of connecting to Discord.")
+    parser.add_argument("--duration", type=float, default=0, help="Stop after this many seconds (0 = run forever).")
+    parser.add_argument("--health-interval", type=float, default=15.0, help="Seconds between health table prints.")
+    parser.add_argument("--stale-after", type=float, default=90.0, help="Restart a cluster whose last report is older than this.")
+    args = parser.parse_args()
+    mock_dir = None
+    if args.store is None:
+        if args.mock: # Never let fake traffic near the real store unless asked to
+            mock_dir = tempfile.mkdtemp(prefix="mock_cluster_")
+            args.store = os.path.join(mock_dir, "cluster_state.db")
+        else:
+            args.store = os.getenv("BOT_SHARED_STORE_PATH", DEFAULT_STORE_PATH)
+
+    load_dotenv("/home/server/rinandlen.env")
+    if args.shards:
+        total_shards = args.shards
+    elif args.mock:
+        total_shards = args.clusters * 2
+    else:
+        token = os.getenv("DISCORD_TOKEN")
+        if not token:
+            raise ValueError("Missing DISCORD_TOKEN environment variable.")
+        total_shards = recommended_shard_count(token)
+        print(f"Discord recommends {total_shards} shard(s).")
+    cluster_count = max(1, min(args.clusters, total_shards))
+
+    store = SharedStore(args.store)
+    for key in store.items("cluster_health"):
+        store.delete("cluster_health", key) # Drop reports from a previous run
+    if args.mock:
+        store.set("mock", "messages", 0)
+    os.environ.setdefault("BOT_HEALTH_INTERVAL", str(min(args.health_interval, 15.0)))
+
+    clusters = [
+        Cluster(cluster_id, shard_ids, total_shards, args.store, args.mock)
+        for cluster_id, shard_ids in enumerate(assign_shards(total_shards, cluster_count))
+    ]
+    for cluster in clusters:
+        cluster.start()
+
+    stopping = False
+    def _stop(*_):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    started = time.time()
+    next_print = started + args.health_interval
+    try:
+        while not stopping:
+            time.sleep(1.0)
+            now = time.time()
+            if args.duration and now - started >= args.duration:
+                break
+            health = store.items_with_age("cluster_health")
+            for cluster in clusters:
+                _, age = health.get(str(cluster.cluster_id), (None, None))
+                if not cluster.is_alive():
+                    # Back off a little so a cluster that crashes on startup doesn't spin
+                    if now - cluster.started_at < min(60, 5 * (cluster.restarts + 1)):
+                        continue
+                    print(f"Cluster {cluster.cluster_id} exited (code {cluster.process.returncode}); restarting.")
+                elif age is not None and age > args.stale_after and now - cluster.started_at > args.stale_after:
+                    print(f"Cluster {cluster.cluster_id} stopped reporting health {age:.0f}s ago; restarting.")
+                    cluster.stop()
+                else:
+                    continue
+                cluster.restarts += 1
+                cluster.start()
+            if now >= next_print:
+                print_health(store, clusters, args.stale_after)
+                next_print = now + args.health_interval
+    finally:
+        print("Stopping clusters...")
+        for cluster in clusters:
+            cluster.stop()
+        print_health(store, clusters, args.stale_after)
+        if args.mock:
+            reported = sum(r.get("messages_written", 0) for r in store.items("cluster_health").values())
+            counted = store.get("mock", "messages", 0)
+            status = "OK" if reported == counted else "LOST UPDATES"
+            print(f"Mock run: clusters reported {reported} writes, shared counter saw {counted} ({status}).")
+        store.close()
+        if mock_dir:
+            shutil.rmtree(mock_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+# utils/__init__.py
+# Helper modules shared by the cogs, bot.py and launcher.py.
+# Nothing in here is loaded as a cog (bot.py only scans the cogs/ directory).
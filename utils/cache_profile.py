@@ -0,0 +1,39 @@
+# utils/cache_profile.py
+# Gateway intents and cache settings for the bot (BOT_CACHE_PROFILE). "default" is what bot.py always
+# used: discord.py's default intents plus message content, a 1000-message cache and members cached
+# per the intents. "lean" is for large deployments: AICog only needs mentions, DMs, raw delete/edit
+# events and the guild/channel/role cache, so everything else is neither received nor kept.
+import os
+from typing import Any, Dict
+
+import discord
+
+PROFILES = ("default", "lean")
+
+
+def build_client_options(profile: str) -> Dict[str, Any]:
+    """Keyword arguments for commands.Bot / AutoShardedBot for the given cache profile."""
+    profile = (profile or "default").lower()
+    if profile not in PROFILES:
+        print(f"Unknown BOT_CACHE_PROFILE '{profile}', using 'default'.")
+        profile = "default"
+
+    if profile == "default":
+        intents = discord.Intents.default()
+        intents.message_content = True
+        return {"intents": intents}
+
+    intents = discord.Intents.none()
+    intents.guilds = True # Guild, channel and role cache (get_guild, get_channel, guild.me, role checks)
+    intents.guild_messages = True # Mentions, plus raw message delete/edit for cancelling generations
+    intents.dm_messages = True
+    intents.message_content = True
+    # No typing, reactions, voice states, presences, invites, emoji/sticker, integration or webhook events.
+    # Without the emoji/sticker intent discord.py also skips caching every guild's emojis and stickers.
+    max_messages = int(os.getenv("BOT_MAX_MESSAGES", "0")) # discord.py treats 0 as 1000, so 0 here means off
+    return {
+        "intents": intents,
+        "max_messages": max_messages if max_messages > 0 else None,
+        "member_cache_flags": discord.MemberCacheFlags.none(), # Only the bot's own member is kept per guild
+        "chunk_guilds_at_startup": False,
+    }
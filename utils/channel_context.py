@@ -0,0 +1,80 @@
+# utils/channel_context.py
+# Recent messages of a channel, shared by everyone talking to the bot there. Each channel gets a
+# bounded ring of messages with running token and memory totals that are updated as messages arrive
+# and fall out, so building the prompt slice only walks the messages it returns.
+import sys
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+ENTRY_OVERHEAD = 120 # Approximate bytes of the __slots__ record and deque slot per message
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English chat text)."""
+    return len(text) // 4 + 1
+
+
+class ChannelMessage:
+    __slots__ = ("author_name", "content", "tokens", "size")
+
+    def __init__(self, author_name: str, content: str):
+        self.author_name = author_name
+        self.content = content
+        self.tokens = estimate_tokens(author_name) + estimate_tokens(content) + 1
+        self.size = sys.getsizeof(author_name) + sys.getsizeof(content) + ENTRY_OVERHEAD
+
+
+class ChannelContext:
+    """Bounded ring of one channel's recent messages.
+
+    Holds at most `max_messages` messages and at most `max_bytes` of memory (oldest dropped first);
+    a single message longer than the byte cap is cut down to fit.
+    """
+    __slots__ = ("_entries", "max_messages", "max_bytes", "tokens", "size")
+
+    def __init__(self, max_messages: int, max_bytes: int):
+        self._entries: Deque[ChannelMessage] = deque()
+        self.max_messages = max(1, max_messages)
+        self.max_bytes = max(1024, max_bytes)
+        self.tokens = 0 # Running totals over everything in the ring
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def append(self, author_name: str, content: str):
+        limit = self.max_bytes // 4 # Worst case 4 bytes per character; leaves room for the record itself
+        if len(content) > limit:
+            content = content[:limit] + "..."
+        entry = ChannelMessage(author_name, content)
+        self._entries.append(entry)
+        self.tokens += entry.tokens
+        self.size += entry.size
+        while len(self._entries) > self.max_messages or (self.size > self.max_bytes and len(self._entries) > 1):
+            dropped = self._entries.popleft()
+            self.tokens -= dropped.tokens
+            self.size -= dropped.size
+
+    def window(self, token_budget: int) -> List[ChannelMessage]:
+        """The newest messages that fit in `token_budget`, oldest first. Stops at the first one that doesn't fit."""
+        if self.tokens <= token_budget:
+            return list(self._entries) # Everything fits; no need to count
+        picked = []
+        used = 0
+        for entry in reversed(self._entries):
+            if used + entry.tokens > token_budget:
+                break
+            picked.append(entry)
+            used += entry.tokens
+        picked.reverse()
+        return picked
+
+    def render(self, token_budget: int) -> Optional[str]:
+        """The window as one text block ("name: message" lines), or None if the channel is empty."""
+        entries = self.window(token_budget)
+        if not entries:
+            return None
+        return "\n".join(f"{e.author_name}: {e.content}" for e in entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"messages": len(self._entries), "tokens": self.tokens, "bytes": self.size}
@@ -0,0 +1,156 @@
+# utils/chat_jobs.py
+# Background jobs for the /chat slash command. The command defers its interaction right away and queues a
+# ChatJob here; a few consumer tasks run the jobs through `handler` (the cog's run_chat_job), which answers
+# via the interaction's followup webhook. That way the interaction is acknowledged within Discord's
+# 3-second deadline no matter how slow the model is.
+#
+# The queue is bounded overall and per user, so a burst of /chat can't pile up unbounded work; `submit`
+# raises ChatQueueFull instead. `handler` is looked up on every job, so after a reload the new cog
+# instance can take over the queue (and its running consumers) by replacing it.
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class ChatQueueFull(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason # "queue" (all slots taken) or "user" (this user has too many jobs)
+
+
+class ChatJob:
+    __slots__ = ("job_id", "user_id", "prompt", "interaction", "private", "status", "queued_at", "started_at", "finished_at",
+                 "progress")
+
+    def __init__(self, job_id: str, user_id: str, prompt: str, interaction: Any, private: bool = False):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.interaction = interaction
+        self.private = private
+        self.status = QUEUED
+        self.queued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress: Optional[asyncio.Task] = None # The caller's progress updater, if any; stopped when the job ends
+
+    @property
+    def waited(self) -> float:
+        return (self.started_at or time.monotonic()) - self.queued_at
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - (self.started_at or self.queued_at)
+
+
+class ChatJobQueue:
+    def __init__(self, handler: Callable[[ChatJob], Awaitable[None]], maxsize: int = 100, workers: int = 4, per_user: int = 2):
+        self.handler = handler
+        self.maxsize = max(1, maxsize)
+        self.workers = max(1, workers)
+        self.per_user = max(1, per_user)
+        self.waiting: Deque[ChatJob] = deque() # Oldest first
+        self.running: Dict[str, ChatJob] = {}
+        self.stats = {"submitted": 0, "done": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self.wait_times: Deque[float] = deque(maxlen=500)
+        self.run_times: Deque[float] = deque(maxlen=500)
+        self._ids = itertools.count(1)
+        self._per_user: Dict[str, int] = {}
+        self._ready: Optional[asyncio.Semaphore] = None # Counts jobs in `waiting`; made on first submit (needs a loop)
+        self._consumers: List[asyncio.Task] = []
+
+    def new_job_id(self) -> str:
+        return f"{next(self._ids):04x}"
+
+    def submit(self, job: ChatJob) -> int:
+        """Queues a job and returns its position (see `position`). Raises ChatQueueFull if it can't take it."""
+        if len(self.waiting) >= self.maxsize + max(0, self.workers - len(self.running)): # Jobs an idle consumer is about to take don't count
+            self.stats["rejected"] += 1
+            raise ChatQueueFull("queue")
+        if self._per_user.get(job.user_id, 0) >= self.per_user:
+            self.stats["rejected"] += 1
+            raise ChatQueueFull("user")
+        if self._ready is None:
+            self._ready = asyncio.Semaphore(0)
+        self._consumers = [task for task in self._consumers if not task.done()]
+        while len(self._consumers) < self.workers:
+            self._consumers.append(asyncio.create_task(self._consume()))
+        self._per_user[job.user_id] = self._per_user.get(job.user_id, 0) + 1
+        self.waiting.append(job)
+        self.stats["submitted"] += 1
+        self._ready.release()
+        return self.position(job)
+
+    def position(self, job: ChatJob) -> int:
+        """How many jobs have to start before this one can (0 = it's running or about to)."""
+        for index, waiting_job in enumerate(self.waiting):
+            if waiting_job is job:
+                return max(0, index + 1 - (self.workers - len(self.running)))
+        return 0
+
+    def cancel(self, job: ChatJob) -> bool:
+        """Drops a job that hasn't started yet."""
+        if job.status != QUEUED or job not in self.waiting:
+            return False
+        self.waiting.remove(job)
+        self._finish(job, CANCELLED)
+        return True
+
+    async def _consume(self):
+        while True:
+            await self._ready.acquire()
+            if not self.waiting: # Its job was cancelled while queued
+                continue
+            job = self.waiting.popleft()
+            job.status = RUNNING
+            job.started_at = time.monotonic()
+            self.wait_times.append(job.waited)
+            self.running[job.job_id] = job
+            try:
+                await self.handler(job)
+            except asyncio.CancelledError:
+                self._finish(job, CANCELLED)
+                raise
+            except Exception as e:
+                print(f"Error running /chat job {job.job_id} for user {job.user_id}: {e}")
+                self._finish(job, FAILED)
+            else:
+                self._finish(job, DONE)
+
+    def _finish(self, job: ChatJob, status: str):
+        job.status = status
+        job.finished_at = time.monotonic()
+        if job.progress is not None:
+            job.progress.cancel()
+        self.running.pop(job.job_id, None)
+        self.stats[status] += 1
+        if job.started_at is not None and status != CANCELLED:
+            self.run_times.append(job.elapsed)
+        remaining = self._per_user.get(job.user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[job.user_id] = remaining
+        else:
+            self._per_user.pop(job.user_id, None)
+
+    def close(self) -> List[ChatJob]:
+        """Stops the consumers (cancelling the jobs they're running) and drops everything still queued.
+        Returns those jobs, so the caller can tell their users they won't get an answer."""
+        stopped = list(self.running.values()) + list(self.waiting)
+        for task in self._consumers:
+            task.cancel()
+        self._consumers = []
+        while self.waiting:
+            self._finish(self.waiting.popleft(), CANCELLED)
+        return stopped
+
+    def summary(self) -> Dict[str, Any]:
+        def percentile(values, fraction):
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+        return dict(self.stats, queued=len(self.waiting), running=len(self.running),
+                    wait_p50=percentile(self.wait_times, 0.5), wait_p95=percentile(self.wait_times, 0.95),
+                    run_p50=percentile(self.run_times, 0.5), run_p95=percentile(self.run_times, 0.95))
@@ -0,0 +1,120 @@
+# utils/circuit_breaker.py
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the circuit is open."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"circuit open, next probe in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker driven by the recent error rate and timeout rate.
+
+    Closed: requests flow and their outcomes ("ok", "error" or "timeout") are kept for `window` seconds.
+    Once there are at least `min_requests` outcomes and either rate crosses its threshold, the circuit
+    opens and `allow_request` refuses everything. After `open_seconds` a probe is due; the owner runs
+    one (see `probe_due`/`begin_probe`/`end_probe`), which holds the circuit half-open. A good probe
+    closes it, a bad one re-opens it for twice as long (capped at `max_open_seconds`).
+    """
+
+    def __init__(self, window: float = 60.0, min_requests: int = 5, error_rate: float = 0.5,
+                 timeout_rate: float = 0.3, open_seconds: float = 15.0, max_open_seconds: float = 300.0,
+                 on_transition: Optional[Callable[[str, str, str], None]] = None):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.on_transition = on_transition # Called as (old_state, new_state, reason)
+        self.state = CLOSED
+        self.changed_at = time.time()
+        self.transitions: Counter = Counter() # "closed->open": n, ...
+        self._outcomes: Deque[Tuple[float, str]] = deque()
+        self._open_for = open_seconds
+        self._retry_at = 0.0
+
+    # --- Request path ---
+    def allow_request(self) -> bool:
+        return self.state == CLOSED
+
+    def retry_in(self) -> float:
+        return max(0.0, self._retry_at - time.monotonic())
+
+    def record(self, outcome: str):
+        """Records a finished request: "ok", "error" or "timeout". Ignored unless closed."""
+        if self.state != CLOSED:
+            return
+        now = time.monotonic()
+        self._outcomes.append((now, outcome))
+        self._prune(now)
+        total = len(self._outcomes)
+        if total < self.min_requests:
+            return
+        counts = Counter(kind for _, kind in self._outcomes)
+        if counts["timeout"] / total >= self.timeout_rate:
+            self._open(f"timeout rate {counts['timeout']}/{total} in {self.window:.0f}s")
+        elif (counts["error"] + counts["timeout"]) / total >= self.error_rate:
+            self._open(f"error rate {counts['error'] + counts['timeout']}/{total} in {self.window:.0f}s")
+
+    def _prune(self, now: float):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+    # ----------------------
+
+    # --- Probes ---
+    def probe_due(self) -> bool:
+        return self.state == OPEN and time.monotonic() >= self._retry_at
+
+    def begin_probe(self):
+        self._transition(HALF_OPEN, "probing upstream")
+
+    def end_probe(self, ok: bool, detail: str = ""):
+        if self.state != HALF_OPEN:
+            return
+        if ok:
+            self._outcomes.clear()
+            self._open_for = self.open_seconds
+            self._transition(CLOSED, "probe succeeded")
+        else:
+            self._open_for = min(self.max_open_seconds, self._open_for * 2)
+            self._open(f"probe failed{': ' + detail if detail else ''}", reset_backoff=False)
+    # --------------
+
+    def _open(self, reason: str, reset_backoff: bool = True):
+        if reset_backoff:
+            self._open_for = self.open_seconds
+        self._retry_at = time.monotonic() + self._open_for
+        self._transition(OPEN, f"{reason}; next probe in {self._open_for:.0f}s")
+
+    def _transition(self, new_state: str, reason: str):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        self.changed_at = time.time()
+        self.transitions[f"{old_state}->{new_state}"] += 1
+        if self.on_transition:
+            self.on_transition(old_state, new_state, reason)
+
+    def stats(self) -> Dict:
+        self._prune(time.monotonic())
+        counts = Counter(kind for _, kind in self._outcomes)
+        return {
+            "state": self.state,
+            "since": self.changed_at,
+            "retry_in": self.retry_in() if self.state == OPEN else 0.0,
+            "window_requests": len(self._outcomes),
+            "window_errors": counts["error"],
+            "window_timeouts": counts["timeout"],
+            "transitions": dict(self.transitions),
+        }
@@ -0,0 +1,56 @@
+# utils/debounce.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class DebounceBatch:
+    """Items that arrive close together and get handled once, after the burst goes quiet.
+
+    Each new item pushes the deadline out to `window` seconds after it, but never past `max_wait`
+    seconds after the first item, so a steady trickle can't postpone the answer indefinitely.
+    """
+    __slots__ = ("items", "window", "max_wait", "first_at", "last_at", "task", "started", "committed")
+
+    def __init__(self, window: float, max_wait: float):
+        self.items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.window = max(0.0, window)
+        self.max_wait = max(self.window, max_wait)
+        self.first_at: Optional[float] = None
+        self.last_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.started = False # Set once the wait is over and the batch is being handled
+        self.committed = False # Set by the handler once its result is final (e.g. the reply is written to history)
+
+    def add(self, key: Hashable, item: Any):
+        now = time.monotonic()
+        if self.first_at is None:
+            self.first_at = now
+        self.last_at = now
+        self.items[key] = item
+
+    def absorb(self, other: "DebounceBatch"):
+        """Takes over another batch's items, keeping its start time (so its max wait still applies)."""
+        for key, item in other.items.items():
+            self.items[key] = item
+        if other.first_at is not None:
+            self.first_at = other.first_at if self.first_at is None else min(self.first_at, other.first_at)
+        self.last_at = max(self.last_at, other.last_at)
+
+    def remove(self, key: Hashable) -> bool:
+        return self.items.pop(key, None) is not None
+
+    def deadline(self) -> float:
+        if self.first_at is None:
+            return 0.0
+        return min(self.last_at + self.window, self.first_at + self.max_wait)
+
+    async def wait(self):
+        """Sleeps until the deadline, which may move while we sleep."""
+        while True:
+            remaining = self.deadline() - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        self.started = True
@@ -0,0 +1,272 @@
+# utils/endpoint_router.py
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import aiohttp
+
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class Endpoint:
+    """One OpenAI-compatible chat completions URL plus its latency/health bookkeeping."""
+
+    def __init__(self, url: str, api_key: Optional[str] = None, name: Optional[str] = None):
+        self.url = url
+        self.api_key = api_key # Overrides the caller's Authorization header when set
+        self.name = name or url
+        self.ewma: Optional[float] = None # Smoothed latency of successful requests, seconds
+        self.recent: Deque[float] = deque(maxlen=200)
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.hedges_won = 0
+
+    def record_success(self, latency: float, alpha: float):
+        self.ewma = latency if self.ewma is None else alpha * latency + (1 - alpha) * self.ewma
+        self.recent.append(latency)
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_cancelled(self, elapsed: float, alpha: float):
+        """A cancelled request (e.g. a hedge that lost) took at least `elapsed`; only ever raises the EWMA."""
+        if self.ewma is None or elapsed > self.ewma:
+            self.ewma = elapsed if self.ewma is None else alpha * elapsed + (1 - alpha) * self.ewma
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        # Back off 2s, 4s, 8s ... up to a minute; a cooling endpoint is only tried after healthy ones
+        self.cooldown_until = time.monotonic() + min(60.0, 2.0 ** self.consecutive_failures)
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def score(self) -> float:
+        """Lower is better. Untried endpoints score 0 so they get measured."""
+        return (self.ewma or 0.0) * (1 + self.in_flight)
+
+    def p95(self) -> Optional[float]:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class RoutedResponse:
+    """Fully read upstream response. Mirrors the bits of aiohttp.ClientResponse the AI cog uses."""
+
+    def __init__(self, status: int, body: bytes, endpoint: Endpoint):
+        self.status = status
+        self.body = body
+        self.endpoint = endpoint
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+
+class UpstreamError(Exception):
+    """An attempt that should fail over: a connection error/timeout (`cause`) or a 5xx (`response`)."""
+
+    def __init__(self, endpoint: Endpoint, cause: Optional[BaseException] = None,
+                 response: Optional[RoutedResponse] = None):
+        super().__init__(f"{endpoint.name}: {cause or f'HTTP {response.status}'}")
+        self.endpoint = endpoint
+        self.cause = cause
+        self.response = response
+
+
+class _RoutedRequest:
+    """Lets callers keep the `async with session.post(...) as response:` shape."""
+
+    def __init__(self, router: "EndpointRouter", kwargs: Dict):
+        self._router = router
+        self._kwargs = kwargs
+
+    async def __aenter__(self) -> RoutedResponse:
+        return await self._router.request(**self._kwargs)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class EndpointRouter:
+    """Sends each request to the fastest healthy endpoint, failing over on connection errors and 5xx.
+
+    Endpoints are ranked by EWMA latency (scaled by requests already in flight there). With hedging on,
+    a request still pending after the endpoint's observed p95 latency is also sent to the next-best
+    endpoint; the first good answer wins and the other request is cancelled.
+    """
+
+    HEDGE_MIN_SAMPLES = 20 # Don't trust a p95 until an endpoint has this many successes
+
+    def __init__(self, endpoints: List[Endpoint], hedge: bool = False, hedge_min_delay: float = 1.0,
+                 alpha: float = 0.2, breaker: Optional[CircuitBreaker] = None):
+        if not endpoints:
+            raise ValueError("EndpointRouter needs at least one endpoint")
+        self.endpoints = endpoints
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.alpha = alpha
+        self.breaker = breaker # Sees one outcome per request (after failover), not one per endpoint attempt
+        self.hedged = 0
+        self.failovers = 0
+
+    @classmethod
+    def from_env(cls, default_url: str, breaker: Optional[CircuitBreaker] = None) -> "EndpointRouter":
+        """Builds the router from AI_API_ENDPOINTS, falling back to `default_url`.
+
+        AI_API_ENDPOINTS is a comma-separated list of URLs; an entry may be written `url|ENV_NAME` to
+        send the API key stored in that environment variable instead of the default AI_API_KEY.
+        """
+        endpoints = []
+        for entry in os.getenv("AI_API_ENDPOINTS", "").split(","):
+            url, _, key_env = entry.strip().partition("|")
+            if url:
+                endpoints.append(Endpoint(url, os.getenv(key_env) if key_env else None))
+        return cls(
+            endpoints or [Endpoint(default_url)],
+            hedge=os.getenv("AI_HEDGE_REQUESTS", "0") == "1",
+            hedge_min_delay=float(os.getenv("AI_HEDGE_MIN_DELAY", "1.0")),
+            breaker=breaker,
+        )
+
+    def ordered(self) -> List[Endpoint]:
+        """Healthy endpoints by score, then cooling-down ones (soonest to recover first)."""
+        now = time.monotonic()
+        healthy = sorted((e for e in self.endpoints if e.available(now)), key=Endpoint.score)
+        cooling = sorted((e for e in self.endpoints if not e.available(now)), key=lambda e: e.cooldown_until)
+        return healthy + cooling
+
+    def post(self, session: aiohttp.ClientSession, data: bytes, headers: Dict[str, str],
+             timeout: float, hedge: Optional[bool] = None, probe: bool = False) -> _RoutedRequest:
+        return _RoutedRequest(self, dict(session=session, data=data, headers=headers, timeout=timeout, hedge=hedge, probe=probe))
+
+    async def request(self, session: aiohttp.ClientSession, data: bytes, headers: Dict[str, str],
+                      timeout: float, hedge: Optional[bool] = None, probe: bool = False) -> RoutedResponse:
+        """Returns the first non-5xx response. If every endpoint fails, returns the last 5xx or raises the last error.
+
+        Raises CircuitOpenError without touching the network while the breaker is open, unless this is
+        the breaker's own `probe`.
+        """
+        breaker = None if probe else self.breaker
+        if breaker and not breaker.allow_request():
+            raise CircuitOpenError(breaker.retry_in())
+        try:
+            response = await self._route(session, data, headers, timeout, hedge)
+        except asyncio.TimeoutError: # Includes aiohttp's ServerTimeoutError
+            if breaker:
+                breaker.record("timeout")
+            raise
+        except aiohttp.ClientError:
+            if breaker:
+                breaker.record("error")
+            raise
+        if breaker:
+            breaker.record("error" if response.status >= 500 else "ok")
+        return response
+
+    async def _route(self, session, data, headers, timeout, hedge: Optional[bool]) -> RoutedResponse:
+        hedge = self.hedge if hedge is None else hedge and len(self.endpoints) > 1
+        remaining = self.ordered()
+        last_error: Optional[UpstreamError] = None
+        while remaining:
+            primary = remaining.pop(0)
+            if last_error is not None:
+                self.failovers += 1
+                print(f"EndpointRouter: {last_error}; failing over to {primary.name}")
+            try:
+                if hedge and remaining:
+                    return await self._hedged(session, primary, remaining, data, headers, timeout)
+                return await self._attempt(session, primary, data, headers, timeout)
+            except UpstreamError as e:
+                last_error = e
+        if last_error.response is not None:
+            return last_error.response
+        raise last_error.cause
+
+    async def _hedged(self, session, primary: Endpoint, remaining: List[Endpoint], data, headers, timeout) -> RoutedResponse:
+        first = asyncio.ensure_future(self._attempt(session, primary, data, headers, timeout))
+        delay = self.hedge_delay(primary)
+        if delay is None:
+            return await first
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+        except asyncio.CancelledError:
+            first.cancel() # asyncio.wait doesn't cancel what it waits on
+            raise
+        if done:
+            return first.result()
+        backup = remaining.pop(0) # Tried here, so the failover loop skips it
+        self.hedged += 1
+        second = asyncio.ensure_future(self._attempt(session, backup, data, headers, timeout))
+        pending = {first, second}
+        error: Optional[UpstreamError] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        result = task.result()
+                    except UpstreamError as e:
+                        error = e
+                        continue
+                    if task is second:
+                        backup.hedges_won += 1
+                    return result
+            raise error
+        finally:
+            for task in pending: # The slower request (or both, if our caller was cancelled)
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def hedge_delay(self, endpoint: Endpoint) -> Optional[float]:
+        if len(endpoint.recent) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, endpoint.p95())
+
+    async def _attempt(self, session, endpoint: Endpoint, data, headers, timeout) -> RoutedResponse:
+        if endpoint.api_key:
+            headers = {**headers, "Authorization": f"Bearer {endpoint.api_key}"}
+        endpoint.in_flight += 1
+        started = time.monotonic()
+        try:
+            async with session.post(endpoint.url, headers=headers, data=data, timeout=timeout) as response:
+                status = response.status
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            endpoint.record_failure()
+            raise UpstreamError(endpoint, cause=e)
+        except asyncio.CancelledError:
+            endpoint.record_cancelled(time.monotonic() - started, self.alpha)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        result = RoutedResponse(status, body, endpoint)
+        if status >= 500:
+            endpoint.record_failure()
+            raise UpstreamError(endpoint, response=result)
+        endpoint.record_success(time.monotonic() - started, self.alpha)
+        return result
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        return [{
+            "name": e.name,
+            "ewma": e.ewma,
+            "p95": e.p95(),
+            "in_flight": e.in_flight,
+            "successes": e.successes,
+            "failures": e.failures,
+            "hedges_won": e.hedges_won,
+            "cooling_down": not e.available(now),
+        } for e in self.endpoints]
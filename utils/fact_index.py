@@ -0,0 +1,156 @@
+# utils/fact_index.py
+# Relevance ranking for a user's remembered facts, so the prompt only carries the few that matter for the
+# current message instead of all of them. Facts are vectorized with the hashing trick (no vocabulary to
+# build or store): each word and adjacent word pair is hashed into one of DIMS buckets, and TF-IDF cosine
+# similarity against the query picks the top-k. A user's index is appended to as facts are added.
+#
+# With NumPy installed the index is a sparse matrix kept sorted by bucket (an inverted index), so a query
+# only touches the rows sharing one of its buckets. IDF weights and row norms are recomputed once after
+# facts were added, at the next query. Without NumPy the same scoring runs in pure Python over every fact.
+import math
+import re
+import zlib
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError: # Optional: pure-Python scoring (fine for a few hundred facts per user)
+    np = None
+
+BACKEND = "numpy" if np is not None else "python"
+DIMS = 1 << 20 # Hash buckets; only buckets that occur are ever stored, so this costs nothing but keeps collisions rare
+TOKEN = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do does for from has have he her his i i'm in is it its it's me my of on or "
+    "our she so that the their them they this to was we were what when where which who will with you your".split()
+)
+
+
+def _fold(word: str) -> str:
+    """Crude plural folding, so "cats" matches "cat" (no stemmer dependency)."""
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is", "'s")):
+        return word[:-1]
+    return word[:-2] if word.endswith("'s") else word
+
+
+def features(text: str) -> Dict[int, float]:
+    """Hashed term weights (1 + log tf) for the words and adjacent word pairs of `text`."""
+    words = [_fold(w) for w in TOKEN.findall(text.lower()) if w not in STOPWORDS]
+    counts: Dict[int, int] = {}
+    for term in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        bucket = zlib.crc32(term.encode("utf-8")) % DIMS # Stable across processes, unlike hash()
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return {bucket: 1.0 + math.log(count) for bucket, count in counts.items()}
+
+
+def _idf(doc_count: int, doc_freq: int) -> float:
+    return math.log(1 + doc_count) - math.log(1 + doc_freq) + 1.0
+
+
+class FactIndex:
+    """One user's facts as hashed TF vectors, in the same order as the facts list it mirrors."""
+
+    def __init__(self, facts: Sequence[str] = ()):
+        self.count = 0
+        self.last: Optional[str] = None # With `count`, lets the caller notice the facts list changed elsewhere
+        if np is not None:
+            self._pending: List[Dict[int, float]] = [] # Added since the last query
+            self._buckets = np.zeros(0, dtype=np.int32) # Every stored term, sorted by bucket
+            self._rows = np.zeros(0, dtype=np.int32) # Fact position of each stored term
+            self._tf = np.zeros(0, dtype=np.float32)
+            self._unit = np.zeros(0, dtype=np.float32) # TF-IDF weight / row norm, ready for the dot product
+        else:
+            self.rows: List[Dict[int, float]] = []
+            self.doc_freq: Dict[int, int] = {}
+        for fact in facts:
+            self.add(fact)
+
+    def matches(self, facts: Sequence[str]) -> bool:
+        return self.count == len(facts) and (not facts or facts[-1] == self.last)
+
+    def add(self, fact: str):
+        vector = features(fact)
+        if np is not None:
+            self._pending.append(vector)
+        else:
+            self.rows.append(vector)
+            for bucket in vector:
+                self.doc_freq[bucket] = self.doc_freq.get(bucket, 0) + 1
+        self.count += 1
+        self.last = fact
+
+    @property
+    def terms(self) -> int:
+        if np is not None:
+            return len(self._buckets) + sum(len(v) for v in self._pending)
+        return sum(len(row) for row in self.rows)
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        """Positions of the (at most) k facts most similar to `query`, best first; facts sharing no terms are left out."""
+        query_vector = features(query)
+        if not query_vector or not self.count or k <= 0:
+            return []
+        if np is None:
+            return self._top_k_python(query_vector, k)
+        if self._pending:
+            self._rebuild()
+
+        keys = np.fromiter(query_vector.keys(), dtype=np.int32, count=len(query_vector))
+        starts = np.searchsorted(self._buckets, keys, side="left")
+        ends = np.searchsorted(self._buckets, keys, side="right")
+        present = ends > starts
+        if not present.any():
+            return []
+        starts, ends = starts[present], ends[present]
+        doc_freq = ends - starts
+        query_weights = np.fromiter(query_vector.values(), dtype=np.float64, count=len(query_vector))[present]
+        query_weights *= math.log(1 + self.count) - np.log1p(doc_freq) + 1.0
+        # Gather the postings of every query bucket and add up each row's share of the dot product
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(doc_freq)[:-1])), doc_freq) + np.arange(doc_freq.sum())
+        dots = np.bincount(self._rows[positions], weights=self._unit[positions] * np.repeat(query_weights, doc_freq), minlength=self.count)
+        candidates = np.flatnonzero(dots > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-dots[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-dots[candidates], kind="stable")].tolist()
+
+    def _rebuild(self):
+        """Folds the pending facts in, then recomputes IDF weights and row norms (document frequencies moved)."""
+        first_row = self.count - len(self._pending)
+        lengths = [len(v) for v in self._pending]
+        total = sum(lengths)
+        buckets = np.fromiter((b for v in self._pending for b in v.keys()), dtype=np.int32, count=total)
+        tf = np.fromiter((w for v in self._pending for w in v.values()), dtype=np.float32, count=total)
+        rows = np.repeat(np.arange(first_row, self.count, dtype=np.int32), lengths)
+        self._pending = []
+        buckets = np.concatenate((self._buckets, buckets))
+        rows = np.concatenate((self._rows, rows))
+        tf = np.concatenate((self._tf, tf))
+        order = np.argsort(buckets, kind="stable")
+        self._buckets, self._rows, self._tf = buckets[order], rows[order], tf[order]
+
+        # Each fact holds a bucket at most once, so a bucket's run length in the sorted array is its document frequency
+        _, run_lengths = np.unique(self._buckets, return_counts=True)
+        doc_freq = np.repeat(run_lengths, run_lengths)
+        tfidf = self._tf * (math.log(1 + self.count) - np.log1p(doc_freq) + 1.0).astype(np.float32)
+        norms = np.sqrt(np.bincount(self._rows, weights=tfidf * tfidf, minlength=self.count)).astype(np.float32)
+        self._unit = tfidf / np.maximum(norms[self._rows], 1e-9)
+
+    def _top_k_python(self, query_vector: Dict[int, float], k: int) -> List[int]:
+        idf = {}
+        scored = []
+        for position, row in enumerate(self.rows):
+            dot = 0.0
+            norm = 0.0
+            for bucket, weight in row.items():
+                w_idf = idf.get(bucket)
+                if w_idf is None:
+                    w_idf = idf[bucket] = _idf(self.count, self.doc_freq[bucket])
+                value = weight * w_idf
+                norm += value * value
+                q = query_vector.get(bucket)
+                if q is not None:
+                    dot += value * q * w_idf
+            if dot > 0:
+                scored.append((dot / math.sqrt(norm), position))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [position for _, position in scored[:k]]
@@ -0,0 +1,201 @@
+# utils/fair_scheduler.py
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional, Tuple
+
+
+class _Waiter:
+    __slots__ = ("guild", "user", "future", "enqueued_at")
+
+    def __init__(self, guild: str, user: str, future: asyncio.Future):
+        self.guild = guild
+        self.user = user
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class _WaitStats:
+    __slots__ = ("count", "total", "max", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: Deque[float] = deque(maxlen=256)
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+        self.recent.append(wait)
+
+    def summary(self) -> Dict[str, float]:
+        ordered = sorted(self.recent)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p95": p95,
+            "max": self.max,
+        }
+
+
+class FairScheduler:
+    """Weighted fair queue for AI generations: fair across guilds first, then across users in a guild.
+
+    Uses stride scheduling: every time a guild (or a user inside it) is served, its "pass" advances by
+    1/weight, and the waiting tenant with the lowest pass goes next. A tenant that was idle re-enters
+    at the current virtual time so it can't bank credit while quiet. Since a tenant's pass only matters
+    while it has requests queued or running, it is forgotten as soon as it goes idle.
+    """
+
+    MAX_TRACKED_TENANTS = 1000 # Per stats table; the least recently served tenants are dropped past this
+
+    def __init__(self, capacity: int, guild_cap: int, user_cap: int,
+                 weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0):
+        self.capacity = max(1, capacity)
+        self.guild_cap = max(1, guild_cap)
+        self.user_cap = max(1, user_cap)
+        self.weights = weights or {} # Keys look like "guild:<id>", "user:<id>" or "dm"
+        self.default_weight = default_weight
+
+        self._queues: Dict[str, Dict[str, Deque[_Waiter]]] = {} # guild -> user -> waiters
+        self._guild_pass: Dict[str, float] = {}
+        self._user_pass: Dict[Tuple[str, str], float] = {}
+        self._guild_vtime = 0.0
+        self._user_vtime: Dict[str, float] = {}
+        self._running = 0
+        self._guild_running: Dict[str, int] = {}
+        self._user_running: Dict[Tuple[str, str], int] = {}
+        self._guild_stats: "OrderedDict[str, _WaitStats]" = OrderedDict() # Least recently served first
+        self._user_stats: "OrderedDict[str, _WaitStats]" = OrderedDict()
+
+    def weight_for(self, key: str) -> float:
+        return max(0.01, float(self.weights.get(key, self.default_weight)))
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for users in self._queues.values() for q in users.values())
+
+    @asynccontextmanager
+    async def slot(self, guild: str, user: str):
+        """Waits for this guild/user's fair turn, then holds a generation slot until the block exits."""
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(guild, user, future)
+        users = self._queues.setdefault(guild, {})
+        if guild not in self._guild_pass or (not users and not self._guild_running.get(guild)):
+            self._guild_pass[guild] = max(self._guild_pass.get(guild, 0.0), self._guild_vtime)
+        user_key = (guild, user)
+        if user not in users and not self._user_running.get(user_key):
+            self._user_pass[user_key] = max(self._user_pass.get(user_key, 0.0), self._user_vtime.get(guild, 0.0))
+        users.setdefault(user, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(guild, user) # We were granted a slot right as we got cancelled
+            else:
+                self._remove_waiter(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release(guild, user)
+
+    def _remove_waiter(self, waiter: _Waiter):
+        users = self._queues.get(waiter.guild, {})
+        queue = users.get(waiter.user)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del users[waiter.user]
+            if not users:
+                self._queues.pop(waiter.guild, None)
+            self._forget_idle(waiter.guild, waiter.user)
+
+    def _release(self, guild: str, user: str):
+        self._running -= 1
+        self._guild_running[guild] -= 1
+        if not self._guild_running[guild]:
+            del self._guild_running[guild]
+        self._user_running[(guild, user)] -= 1
+        if not self._user_running[(guild, user)]:
+            del self._user_running[(guild, user)]
+        self._dispatch()
+        self._forget_idle(guild, user)
+
+    def _forget_idle(self, guild: str, user: str):
+        """Drops the pass of a user (and guild) with nothing queued or running. They re-enter at the
+        virtual time on their next request, so keeping it would only grow the tables."""
+        if user not in self._queues.get(guild, {}) and (guild, user) not in self._user_running:
+            self._user_pass.pop((guild, user), None)
+        if guild not in self._queues and guild not in self._guild_running:
+            self._guild_pass.pop(guild, None)
+            self._user_vtime.pop(guild, None) # None of its users has a pass left to compare against
+
+    def _dispatch(self):
+        while self._running < self.capacity:
+            picked = self._pick()
+            if picked is None:
+                return
+            guild, user = picked
+            users = self._queues[guild]
+            waiter = users[user].popleft()
+            if not users[user]:
+                del users[user]
+            if not users:
+                del self._queues[guild]
+            if waiter.future.done(): # Cancelled between enqueue and dispatch
+                self._forget_idle(guild, user)
+                continue
+
+            self._guild_vtime = self._guild_pass[guild]
+            self._guild_pass[guild] += 1.0 / self.weight_for(f"guild:{guild}" if guild != "dm" else "dm")
+            self._user_vtime[guild] = self._user_pass[(guild, user)]
+            self._user_pass[(guild, user)] += 1.0 / self.weight_for(f"user:{user}")
+
+            self._running += 1
+            self._guild_running[guild] = self._guild_running.get(guild, 0) + 1
+            self._user_running[(guild, user)] = self._user_running.get((guild, user), 0) + 1
+            wait = time.monotonic() - waiter.enqueued_at
+            self._record_wait(self._guild_stats, guild, wait)
+            self._record_wait(self._user_stats, user, wait)
+            waiter.future.set_result(None)
+
+    def _record_wait(self, table: "OrderedDict[str, _WaitStats]", key: str, wait: float):
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = _WaitStats()
+            while len(table) > self.MAX_TRACKED_TENANTS:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        stats.record(wait)
+
+    def _pick(self) -> Optional[Tuple[str, str]]:
+        """Lowest-pass guild under its cap, then the lowest-pass user in it under theirs."""
+        best = None
+        for guild, users in self._queues.items():
+            if self._guild_running.get(guild, 0) >= self.guild_cap:
+                continue
+            eligible = [u for u in users if self._user_running.get((guild, u), 0) < self.user_cap]
+            if not eligible:
+                continue
+            if best is None or self._guild_pass[guild] < self._guild_pass[best[0]]:
+                user = min(eligible, key=lambda u: self._user_pass[(guild, u)])
+                best = (guild, user)
+        return best
+
+    def stats(self, top: int = 10) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Wait-time summaries for the tenants that have waited the longest in total."""
+        def _top(stats: Dict[str, _WaitStats]):
+            ranked = sorted(stats.items(), key=lambda item: item[1].total, reverse=True)[:top]
+            return {key: s.summary() for key, s in ranked}
+        return {"guilds": _top(self._guild_stats), "users": _top(self._user_stats)}
@@ -0,0 +1,138 @@
+# utils/history.py
+# Compact per-user conversation history. Each user gets a fixed-capacity ring buffer of
+# __slots__ records with the role stored as a small integer code, instead of a list of
+# {"role": ..., "content": ...} dicts that gets re-sliced on every append. API-shaped dicts
+# are only built (via to_api) when a request payload needs them; the JSON file is streamed
+# straight from the buffers by write_histories_json.
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from utils.json_codec import encode_string_body
+
+STORY_SO_FAR_PREFIX = "[Story so far] " # Marks the compacted summary entry at the start of a user's history
+
+ROLE_NAMES = ("user", "assistant", "system", "tool")
+ROLE_CODES = {name: code for code, name in enumerate(ROLE_NAMES)}
+_MESSAGE_PREFIXES = tuple(f'    {{"role": "{name}", "content": "'.encode("utf-8") for name in ROLE_NAMES)
+
+
+def is_summary_entry(message: Dict[str, str]) -> bool:
+    """True for the compacted 'story so far' entry that replaces a user's older turns."""
+    return message.get("role") == "system" and message.get("content", "").startswith(STORY_SO_FAR_PREFIX)
+
+
+def trim_history(history: List[Dict[str, str]], max_messages: int) -> List[Dict[str, str]]:
+    """Keeps the newest `max_messages` turns, plus a leading story-so-far summary if there is one.
+
+    List counterpart of HistoryBuffer, used where history is stored as plain JSON (the shared store).
+    """
+    if history and is_summary_entry(history[0]):
+        return [history[0]] + history[1:][-max_messages:]
+    return history[-max_messages:]
+
+
+class HistoryMessage:
+    __slots__ = ("role_code", "content")
+
+    def __init__(self, role_code: int, content: str):
+        self.role_code = role_code
+        self.content = content
+
+    @property
+    def role(self) -> str:
+        return ROLE_NAMES[self.role_code]
+
+    def to_api(self) -> Dict[str, str]:
+        return {"role": ROLE_NAMES[self.role_code], "content": self.content}
+
+
+class HistoryBuffer:
+    """Fixed-capacity ring buffer of one user's messages, plus an optional story-so-far summary.
+
+    Appending is O(1) and never copies: once full, the oldest slot is overwritten in place.
+    """
+    __slots__ = ("_items", "_start", "_size", "summary")
+
+    def __init__(self, capacity: int, summary: Optional[str] = None):
+        self._items: List[Optional[HistoryMessage]] = [None] * max(1, capacity)
+        self._start = 0
+        self._size = 0
+        self.summary = summary # Text after STORY_SO_FAR_PREFIX, or None
+
+    @property
+    def capacity(self) -> int:
+        return len(self._items)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[HistoryMessage]:
+        items, start, capacity = self._items, self._start, len(self._items)
+        for i in range(self._size):
+            yield items[(start + i) % capacity]
+
+    def append(self, role: str, content: str):
+        capacity = len(self._items)
+        record = HistoryMessage(ROLE_CODES.get(role, ROLE_CODES["user"]), content)
+        if self._size < capacity:
+            self._items[(self._start + self._size) % capacity] = record
+            self._size += 1
+        else:
+            self._items[self._start] = record # Overwrite the oldest message
+            self._start = (self._start + 1) % capacity
+
+    def resize(self, capacity: int):
+        """Changes the capacity, keeping the newest messages."""
+        messages = list(self)[-max(1, capacity):]
+        self._items = messages + [None] * (max(1, capacity) - len(messages))
+        self._start = 0
+        self._size = len(messages)
+
+    def to_api(self) -> List[Dict[str, str]]:
+        """API-shaped message dicts, oldest first, with the summary entry (if any) in front."""
+        messages = [m.to_api() for m in self]
+        if self.summary:
+            messages.insert(0, {"role": "system", "content": STORY_SO_FAR_PREFIX + self.summary})
+        return messages
+
+    def to_record(self) -> Tuple[Optional[str], bytes, List[str]]:
+        """Compact builtin-only form for the state snapshot: (summary, role codes, contents), oldest first."""
+        messages = list(self)
+        return self.summary, bytes(m.role_code for m in messages), [m.content for m in messages]
+
+    @classmethod
+    def from_record(cls, record: Tuple[Optional[str], bytes, List[str]], capacity: int) -> "HistoryBuffer":
+        summary, role_codes, contents = record
+        buffer = cls(capacity, summary)
+        messages = [HistoryMessage(code, content) for code, content in zip(role_codes, contents)][-buffer.capacity:]
+        buffer._items[:len(messages)] = messages
+        buffer._size = len(messages)
+        return buffer
+
+    @classmethod
+    def from_api(cls, messages: List[Dict[str, str]], capacity: int) -> "HistoryBuffer":
+        buffer = cls(capacity)
+        for message in messages:
+            if is_summary_entry(message):
+                buffer.summary = message["content"][len(STORY_SO_FAR_PREFIX):]
+            else:
+                buffer.append(message.get("role", "user"), message.get("content") or "")
+        return buffer
+
+    def encode_json(self) -> bytes:
+        """The same list as `to_api`, encoded as JSON with one message per line, without building the dicts."""
+        prefixes = _MESSAGE_PREFIXES
+        lines = [prefixes[message.role_code] + encode_string_body(message.content) + b'"}' for message in self]
+        if self.summary:
+            lines.insert(0, prefixes[ROLE_CODES["system"]] + encode_string_body(STORY_SO_FAR_PREFIX + self.summary) + b'"}')
+        return b"[\n" + b",\n".join(lines) + b"\n  ]" if lines else b"[]"
+
+
+def write_histories_json(buffers: Dict[str, HistoryBuffer], f: IO[bytes]):
+    """Streams {user_id: [message, ...]} into a binary file one user at a time, so saving never holds an
+    API-shaped copy of everyone's history. Reads back with any JSON decoder (see HistoryBuffer.from_api)."""
+    f.write(b"{")
+    separator = b"\n  "
+    for user_id, buffer in buffers.items():
+        f.write(separator + b'"' + encode_string_body(str(user_id)) + b'": ' + buffer.encode_json())
+        separator = b",\n  "
+    f.write(b"\n}" if buffers else b"}")
@@ -0,0 +1,126 @@
+# utils/hot_update.py
+# In-place code updates for the running bot (used by Core's /update). The new revision is fetched into a
+# staging checkout next to the live one and has to compile and import there before anything in the live
+# tree is touched; then only the files that differ are copied over (with a backup of the old copies, so a
+# failed reload can be rolled back) and the caller reloads the affected extensions.
+import asyncio
+import filecmp
+import os
+import shutil
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# Run by the staging interpreter with the staging checkout as cwd; argv holds the modules to import
+IMPORT_CHECK = (
+    "import importlib, sys\n"
+    "for name in sys.argv[1:]:\n"
+    "    module = importlib.import_module(name)\n"
+    "    if name.startswith('cogs.') and not hasattr(module, 'setup'):\n"
+    "        raise SystemExit(f'{name} has no setup() function')\n"
+)
+
+
+class UpdateError(Exception):
+    """A step of the update failed; the message says which one (and includes the tool output)."""
+
+
+async def run(*args: str, cwd: Optional[str] = None, timeout: float = 300.0) -> Tuple[int, str]:
+    """Runs a command without blocking the event loop. Returns (exit code, combined output)."""
+    process = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return -1, f"{args[0]} timed out after {timeout:.0f}s"
+    return process.returncode, output.decode("utf-8", errors="replace").strip()
+
+
+async def _checked(step: str, *args: str, cwd: Optional[str] = None, timeout: float = 300.0) -> str:
+    code, output = await run(*args, cwd=cwd, timeout=timeout)
+    if code != 0:
+        raise UpdateError(f"{step} failed (exit {code}):\n{output[-1500:]}")
+    return output
+
+
+async def fetch_staging(repo_url: str, staging_dir: str, branch: Optional[str] = None) -> str:
+    """Brings the staging checkout up to the latest commit (cloning it the first time). Returns the commit hash."""
+    if os.path.isdir(os.path.join(staging_dir, ".git")):
+        await _checked("git fetch", "git", "-C", staging_dir, "fetch", "--depth", "1", repo_url, branch or "HEAD")
+        await _checked("git reset", "git", "-C", staging_dir, "reset", "--hard", "FETCH_HEAD")
+        await _checked("git clean", "git", "-C", staging_dir, "clean", "-fdx")
+    else:
+        if os.path.exists(staging_dir):
+            await asyncio.to_thread(shutil.rmtree, staging_dir) # Leftover from an interrupted clone
+        args = ["git", "clone", "--depth", "1"] + (["--branch", branch] if branch else []) + [repo_url, staging_dir]
+        await _checked("git clone", *args)
+    return await _checked("git rev-parse", "git", "-C", staging_dir, "rev-parse", "HEAD")
+
+
+def module_name(path: str) -> Optional[str]:
+    """Path to module name ("cogs/ai.py" -> "cogs.ai"); None for anything that isn't a Python module."""
+    if not path.endswith(".py"):
+        return None
+    return path[:-3].replace("/", ".")
+
+
+async def validate(staging_dir: str, modules: List[str]):
+    """Byte-compiles the staging checkout and imports `modules` from it in a separate interpreter."""
+    await _checked("compile check", sys.executable, "-m", "compileall", "-q", "-x", r"[/\\]\.git", staging_dir)
+    if modules:
+        await _checked("import check", sys.executable, "-c", IMPORT_CHECK, *modules, cwd=staging_dir, timeout=120.0)
+
+
+async def changed_files(staging_dir: str, live_dir: str) -> List[str]:
+    """Tracked files in the staging checkout that are new or differ from the live tree (relative paths)."""
+    listing = await _checked("git ls-files", "git", "-C", staging_dir, "ls-files")
+
+    def compare() -> List[str]:
+        changed = []
+        for path in listing.splitlines():
+            live_path = os.path.join(live_dir, path)
+            if not os.path.isfile(live_path) or not filecmp.cmp(os.path.join(staging_dir, path), live_path, shallow=False):
+                changed.append(path)
+        return changed
+
+    return await asyncio.to_thread(compare)
+
+
+def apply_files(staging_dir: str, live_dir: str, paths: List[str], backup_dir: str) -> Dict[str, Optional[str]]:
+    """Copies `paths` from staging into the live tree. Blocking (run it in a thread).
+
+    Returns the rollback manifest: {path: backup copy, or None if the file is new}.
+    """
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir) # Only the most recent update's backup is kept
+    manifest: Dict[str, Optional[str]] = {}
+    try:
+        for path in paths:
+            live_path = os.path.join(live_dir, path)
+            if os.path.isfile(live_path):
+                backup_path = os.path.join(backup_dir, path)
+                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+                shutil.copy2(live_path, backup_path)
+                manifest[path] = backup_path
+            else:
+                manifest[path] = None
+            os.makedirs(os.path.dirname(live_path) or ".", exist_ok=True)
+            shutil.copy2(os.path.join(staging_dir, path), live_path)
+    except Exception:
+        restore_files(live_dir, manifest) # Don't leave a half-copied tree behind
+        raise
+    return manifest
+
+
+def restore_files(live_dir: str, manifest: Dict[str, Optional[str]]):
+    """Undoes apply_files: puts the backed-up files back and removes the ones it added. Blocking."""
+    for path, backup_path in manifest.items():
+        live_path = os.path.join(live_dir, path)
+        try:
+            if backup_path:
+                shutil.copy2(backup_path, live_path)
+            elif os.path.exists(live_path):
+                os.remove(live_path)
+        except OSError as e:
+            print(f"Failed to restore {live_path}: {e}")
@@ -0,0 +1,142 @@
+# utils/json_codec.py
+# One JSON codec for the whole bot: orjson when it's installed (pip install orjson), the stdlib
+# json module otherwise. Both paths produce the same compact UTF-8 output, so files and shared-store
+# rows written by one backend read back fine with the other.
+#
+# It also supports pre-encoded fragments: parts of a request body that never change (the tool
+# schema, the static text of the system prompt) are encoded once and spliced in as bytes instead
+# of being re-serialized on every LLM call.
+import json
+import string
+from json.encoder import encode_basestring as _escape_string # C-accelerated, non-ASCII kept as-is
+from typing import Any, Dict, IO, List, Union
+
+try:
+    import orjson
+except ImportError: # Optional dependency
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+JSONDecodeError = json.JSONDecodeError # orjson.JSONDecodeError subclasses this, so one except covers both
+
+
+# --- Core Encode/Decode ---
+if orjson is not None:
+    def dumps(obj: Any, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        return orjson.loads(data)
+else:
+    _compact = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")) # Built once; json.dumps() with options builds one per call
+    _indented = json.JSONEncoder(ensure_ascii=False, indent=2)
+
+    def dumps(obj: Any, indent: bool = False) -> bytes:
+        return (_indented if indent else _compact).encode(obj).encode("utf-8")
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+
+def dumps_str(obj: Any, indent: bool = False) -> str:
+    """Like `dumps`, but returns text (for SQLite TEXT columns and text-mode files)."""
+    return dumps(obj, indent).decode("utf-8")
+
+
+def load(f: IO) -> Any:
+    """Reads and decodes a whole JSON file (text or binary mode)."""
+    return loads(f.read())
+
+
+def dump(obj: Any, f: IO, indent: bool = True):
+    """Encodes `obj` into a text-mode file. Indented by default, since these files get read by people."""
+    f.write(dumps_str(obj, indent))
+# --------------------------
+
+
+# --- Pre-encoded Fragments ---
+class PreEncoded:
+    """A value that has already been encoded to JSON bytes; `encode_object` splices it in verbatim."""
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    @classmethod
+    def of(cls, obj: Any) -> "PreEncoded":
+        return cls(dumps(obj))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def encode_string_body(text: str) -> bytes:
+    """The escaped inside of a JSON string literal (no surrounding quotes).
+
+    JSON string escaping is per character, so the bodies of consecutive pieces of text can be
+    concatenated and still form the body of the whole text.
+    """
+    if orjson is None:
+        return _escape_string(text)[1:-1].encode("utf-8")
+    return orjson.dumps(text)[1:-1]
+
+
+def encode_object(fields: Dict[str, Any]) -> bytes:
+    """Encodes a flat JSON object whose values may be `PreEncoded`. None values are left out."""
+    parts = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        encoded = value.data if isinstance(value, PreEncoded) else dumps(value)
+        parts.append(dumps(key) + b":" + encoded)
+    return b"{" + b",".join(parts) + b"}"
+
+
+def encode_array(items: List[Any]) -> bytes:
+    """Encodes a JSON array whose items may be `PreEncoded`; runs of plain items are encoded together."""
+    parts = []
+    plain: List[Any] = []
+    for item in items:
+        if isinstance(item, PreEncoded):
+            if plain:
+                parts.append(dumps(plain)[1:-1])
+                plain = []
+            parts.append(item.data)
+        else:
+            plain.append(item)
+    if plain:
+        parts.append(dumps(plain)[1:-1])
+    return b"[" + b",".join(parts) + b"]"
+
+
+class PreEncodedTemplate:
+    """A str.format template whose literal text is JSON-escaped once, up front.
+
+    `encode_message` builds the bytes of a {"role": ..., "content": template.format(...)} message
+    by escaping only the substituted fields and splicing them between the pre-escaped literals.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self._parts = [] # (escaped literal bytes, field name or None)
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if format_spec or conversion:
+                raise ValueError(f"Template field '{field_name}' uses a format spec/conversion, which isn't supported.")
+            if field_name is not None and not field_name:
+                raise ValueError("Template uses positional '{}' fields; name them instead.")
+            self._parts.append((encode_string_body(literal), field_name))
+
+    def format(self, **fields: str) -> str:
+        return self.template.format(**fields)
+
+    def encode_message(self, role: str, **fields: str) -> PreEncoded:
+        body = [b'{"role":', dumps(role), b',"content":"']
+        for literal, field_name in self._parts:
+            body.append(literal)
+            if field_name is not None:
+                body.append(encode_string_body(str(fields[field_name])))
+        body.append(b'"}')
+        return PreEncoded(b"".join(body))
+# -----------------------------
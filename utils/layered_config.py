@@ -0,0 +1,84 @@
+# utils/layered_config.py
+# Global -> guild -> user AI configuration. Guild and user tiers hold only the keys they override;
+# lookups return a read-only view that resolves through the tiers, so nothing is copied per message
+# and changing a global default reaches everyone who hasn't overridden that key.
+from collections import ChainMap
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+
+_NOTHING = object() # Inherited value for a key no tier can be relied on for; never equal to a real value
+
+
+class LayeredConfig:
+    def __init__(self, defaults: Dict[str, Any], guild_overrides: Dict[str, Dict[str, Any]],
+                 user_overrides: Dict[str, Dict[str, Any]]):
+        # The override dicts are shared with the caller (AICog owns and persists them)
+        self.defaults = defaults
+        self.guild_overrides = guild_overrides
+        self.user_overrides = user_overrides
+        self._defaults_view = MappingProxyType(defaults)
+
+    def view(self, user_id: Optional[str], guild_id: Optional[str] = None) -> Mapping[str, Any]:
+        """Read-only resolved configuration for a user (in a guild, if given). Live, never copied."""
+        user = self.user_overrides.get(str(user_id)) if user_id is not None else None
+        guild = self.guild_overrides.get(str(guild_id)) if guild_id is not None else None
+        if not user and not guild:
+            return self._defaults_view # Most users: no allocation at all
+        layers = [layer for layer in (user, guild) if layer]
+        return MappingProxyType(ChainMap(*layers, self.defaults))
+
+    def guild_overridden(self, key: str) -> bool:
+        """True if any guild overrides `key`."""
+        return any(key in overrides for overrides in self.guild_overrides.values())
+
+    def set_user(self, user_id: str, key: str, value: Any) -> bool:
+        """Stores a user override, or drops it if it matches the global default and no guild overrides the key.
+
+        (User overrides follow the user into every guild, so a value equal to the global default still has to
+        be kept while some guild would otherwise shadow it.) Returns True if the stored overrides changed.
+        """
+        inherited = _NOTHING if self.guild_overridden(key) else self.defaults.get(key)
+        return self._set(self.user_overrides, str(user_id), key, value, inherited)
+
+    def set_guild(self, guild_id: str, key: str, value: Any) -> bool:
+        """Stores a guild override, or drops it if it matches the global default."""
+        return self._set(self.guild_overrides, str(guild_id), key, value, self.defaults.get(key))
+
+    def reset_user(self, user_id: str, key: Optional[str] = None) -> bool:
+        """Removes one (or every) override for a user. Returns True if anything was removed."""
+        overrides = self.user_overrides.get(str(user_id))
+        if not overrides:
+            return False
+        if key is None:
+            del self.user_overrides[str(user_id)]
+            return True
+        if key not in overrides:
+            return False
+        del overrides[key]
+        if not overrides:
+            del self.user_overrides[str(user_id)]
+        return True
+
+    def strip_defaults(self, overrides: Dict[str, Any], keep_guild_overridden: bool = False) -> Dict[str, Any]:
+        """Drops keys that merely repeat the global default (old config files stored full copies).
+
+        For user overrides, pass keep_guild_overridden so keys some guild overrides are kept (see set_user).
+        """
+        return {k: v for k, v in overrides.items()
+                if k not in self.defaults or self.defaults[k] != v or (keep_guild_overridden and self.guild_overridden(k))}
+
+    @staticmethod
+    def _set(tier: Dict[str, Dict[str, Any]], owner: str, key: str, value: Any, inherited: Any) -> bool:
+        overrides = tier.get(owner, {})
+        if value == inherited:
+            if key not in overrides:
+                return False
+            del overrides[key]
+            if not overrides:
+                tier.pop(owner, None)
+            return True
+        if overrides.get(key) == value and key in overrides:
+            return False
+        overrides[key] = value
+        tier[owner] = overrides
+        return True
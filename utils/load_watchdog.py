@@ -0,0 +1,152 @@
+# utils/load_watchdog.py
+# Self-protection for the gateway process. A watchdog samples process RSS (including AI worker processes),
+# event-loop lag and the number of pending generations. Each signal has a soft and a hard watermark. Past
+# the soft one the bot degrades in steps as the signal climbs toward the hard one, and at the hard one it
+# stops taking new work:
+#
+#   0 normal    everything as configured
+#   1 trim      shorter history window in the prompt
+#   2 short     lower max_tokens too
+#   3 dm-only   guild messages are ignored, DMs still answered
+#   4 reject    new requests get a "we're overloaded" reply
+#
+# Going up happens on the first sample that calls for it. Coming down is one step at a time, after the
+# signals have called for a lower level for `recover_seconds`, so a brief dip doesn't flap the bot
+# between levels. Every transition is printed and kept for the owner command.
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+try:
+    import psutil
+except ImportError: # Optional: RSS is read from /proc on Linux without it
+    psutil = None
+
+BACKEND = "psutil" if psutil is not None else ("procfs" if os.path.exists("/proc/self/statm") else "none")
+LEVELS = ("normal", "trim", "short", "dm-only", "reject")
+NORMAL, TRIM_HISTORY, SHORT_REPLIES, DMS_ONLY, REJECT = range(len(LEVELS))
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_READ_ERRORS = (OSError, ValueError, IndexError) + ((psutil.Error,) if psutil is not None else ())
+
+
+def process_rss(pids: Iterable[int] = ()) -> Optional[int]:
+    """Resident memory in bytes of this process plus `pids` (processes that went away count as 0).
+    None if there's no way to read it on this platform."""
+    total = 0
+    for pid in [os.getpid(), *pids]:
+        try:
+            if psutil is not None:
+                total += psutil.Process(pid).memory_info().rss
+            elif BACKEND == "procfs":
+                with open(f"/proc/{pid}/statm", "rb") as f:
+                    total += int(f.read().split()[1]) * _PAGE_SIZE
+            else:
+                return None
+        except _READ_ERRORS:
+            continue
+    return total
+
+
+class Watermark(NamedTuple):
+    soft: float # 0 = this signal is ignored
+    hard: float
+
+    def level(self, value: Optional[float]) -> int:
+        """NORMAL below soft, REJECT at hard, and TRIM_HISTORY..DMS_ONLY across thirds of the range in between."""
+        if not self.soft or value is None or value < self.soft:
+            return NORMAL
+        if value >= self.hard:
+            return REJECT
+        fraction = (value - self.soft) / (self.hard - self.soft)
+        return TRIM_HISTORY + min(2, int(fraction * 3))
+
+
+class Transition(NamedTuple):
+    at: float # time.time()
+    old: int
+    new: int
+    reason: str
+
+
+class LoadWatchdog:
+    def __init__(self, rss_mb: Watermark, loop_lag: Watermark, pending: Watermark, interval: float = 1.0,
+                 recover_seconds: float = 30.0):
+        self.watermarks = {"rss_mb": rss_mb, "loop_lag": loop_lag, "pending": pending}
+        for name, mark in self.watermarks.items():
+            if mark.soft and mark.hard <= mark.soft:
+                raise ValueError(f"{name} hard watermark ({mark.hard}) must be above its soft one ({mark.soft})")
+        self.interval = interval
+        self.recover_seconds = recover_seconds
+        self.level = NORMAL
+        self.signals: Dict[str, Optional[float]] = {"rss_mb": None, "loop_lag": None, "pending": None}
+        self.peaks: Dict[str, float] = {name: 0.0 for name in self.signals}
+        self.transitions: Deque[Transition] = deque(maxlen=50)
+        self._calm_since: Optional[float] = None # When the signals first called for a lower level
+
+    @classmethod
+    def from_env(cls) -> "LoadWatchdog":
+        def mark(name: str, soft: str, hard: str) -> Watermark:
+            return Watermark(float(os.getenv(f"AI_{name}_SOFT", soft)), float(os.getenv(f"AI_{name}_HARD", hard)))
+        return cls(
+            rss_mb=mark("RSS_MB", "0", "0"), # e.g. 1500 / 2500; off by default since it depends on the host
+            loop_lag=mark("LOOP_LAG", "0.5", "5"), # Seconds the event loop runs behind
+            pending=mark("PENDING_GENERATIONS", "50", "300"),
+            interval=float(os.getenv("AI_WATCHDOG_INTERVAL", "1")),
+            recover_seconds=float(os.getenv("AI_WATCHDOG_RECOVER_SECONDS", "30")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return any(mark.soft for mark in self.watermarks.values())
+
+    @property
+    def level_name(self) -> str:
+        return LEVELS[self.level]
+
+    def sample(self, rss_bytes: Optional[int], loop_lag: float, pending: int, now: Optional[float] = None) -> Optional[Transition]:
+        """Records one set of readings and moves the level if they call for it. Returns the transition, if any."""
+        now = time.monotonic() if now is None else now
+        self.signals = {"rss_mb": rss_bytes / (1024 * 1024) if rss_bytes is not None else None,
+                        "loop_lag": loop_lag, "pending": pending}
+        levels = {}
+        for name, value in self.signals.items():
+            if value is not None:
+                self.peaks[name] = max(self.peaks[name], value)
+            levels[name] = self.watermarks[name].level(value)
+        target = max(levels.values())
+
+        if target > self.level:
+            self._calm_since = None
+            return self._move(target, self._reason(levels, target))
+        if target == self.level:
+            self._calm_since = None
+            return None
+        if self._calm_since is None:
+            self._calm_since = now
+            return None
+        if now - self._calm_since < self.recover_seconds:
+            return None
+        self._calm_since = now # The next step down needs another calm period
+        return self._move(self.level - 1, f"recovered ({self._readings()})")
+
+    def _reason(self, levels: Dict[str, int], target: int) -> str:
+        causes = [name for name, level in levels.items() if level == target]
+        return f"{', '.join(causes)} past watermark ({self._readings()})"
+
+    def _readings(self) -> str:
+        rss, lag, pending = self.signals["rss_mb"], self.signals["loop_lag"], self.signals["pending"]
+        return f"rss {f'{rss:.0f} MB' if rss is not None else 'n/a'}, loop lag {lag:.2f}s, pending {pending}"
+
+    def _move(self, new: int, reason: str) -> Transition:
+        transition = Transition(time.time(), self.level, new, reason)
+        self.level = new
+        self.transitions.append(transition)
+        print(f"Load watchdog: {LEVELS[transition.old]} -> {LEVELS[new]}: {reason}")
+        return transition
+
+    def recent(self, count: int = 10) -> List[Transition]:
+        return list(self.transitions)[-count:]
+
+    def describe_watermarks(self) -> List[Tuple[str, Watermark]]:
+        return [(name, mark) for name, mark in self.watermarks.items() if mark.soft]
@@ -0,0 +1,242 @@
+# utils/local_search.py
+# Offline search for the search_internet tool: a SQLite FTS5 index over the text files in a documents
+# directory (notes, wiki dumps, lyrics, FAQs...). Files are split into passages of a few paragraphs so a
+# hit points at the relevant part of a long file, and results are ranked with BM25 (title matches count
+# more) and come back with a highlighted snippet.
+#
+# `sync` re-indexes only files whose size or mtime changed and drops deleted ones; the cog runs it in a
+# thread every AI_SEARCH_SYNC_SECONDS. Recent query results are kept in an LRU cache, cleared whenever a
+# sync changes the index.
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+DEFAULT_EXTENSIONS = (".txt", ".md", ".markdown", ".rst", ".html", ".htm")
+PASSAGE_CHARS = 1500 # Paragraphs are grouped into passages of about this size
+MAX_FILE_BYTES = 8 * 1024 * 1024 # Bigger files are skipped
+TERM = re.compile(r"\w+", re.UNICODE)
+TAG = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+HEADING = re.compile(r"^\s*(#{1,6}\s+|title:\s*)(.+)$", re.IGNORECASE | re.MULTILINE)
+
+
+class SearchResult(NamedTuple):
+    path: str # Relative to the documents directory
+    title: str
+    snippet: str
+    score: float # BM25, lower is better
+
+
+def split_passages(text: str, size: int = PASSAGE_CHARS) -> List[str]:
+    """Groups blank-line separated paragraphs into passages of about `size` characters (long paragraphs are cut)."""
+    passages, current, length = [], [], 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > size:
+            cut = paragraph.rfind(" ", 0, size)
+            cut = cut if cut > size // 2 else size
+            passages.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if not paragraph:
+            continue
+        if current and length + len(paragraph) > size:
+            passages.append("\n\n".join(current))
+            current, length = [], 0
+        current.append(paragraph)
+        length += len(paragraph)
+    if current:
+        passages.append("\n\n".join(current))
+    return passages
+
+
+def match_expression(query: str, any_term: bool = False) -> Optional[str]:
+    """FTS5 MATCH expression for free text: every word quoted (so punctuation and keywords like NOT
+    can't break the syntax), all required, or any of them with `any_term`."""
+    terms = list(dict.fromkeys(t.lower() for t in TERM.findall(query)))
+    if not terms:
+        return None
+    return (" OR " if any_term else " ").join(f'"{t}"' for t in terms[:32])
+
+
+class LocalSearch:
+    def __init__(self, db_path: str, docs_dir: str, extensions: Sequence[str] = DEFAULT_EXTENSIONS,
+                 cache_size: int = 256, timeout: float = 30.0):
+        self.db_path = db_path
+        self.docs_dir = os.path.abspath(docs_dir)
+        self.extensions = tuple(e.lower() for e in extensions)
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[Tuple[str, int], List[SearchResult]]" = OrderedDict() # Least recently used first
+        self.stats = {"queries": 0, "cache_hits": 0, "files": 0, "passages": 0, "last_sync": None, "last_sync_seconds": None}
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._cache_lock = threading.Lock() # Searches run in executor threads, cache hits on the event loop
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute( # A file's passages have consecutive rowids, so they're deleted by range, not by a scan
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+                " first_rowid INTEGER NOT NULL, passages INTEGER NOT NULL)")
+            # Raises sqlite3.OperationalError if this SQLite was built without FTS5
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5(path UNINDEXED, title, body, tokenize='porter unicode61')")
+            self.stats["files"] = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            self.stats["passages"] = self._conn.execute("SELECT COUNT(*) FROM passages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Indexing ---
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        found = {}
+        for root, dirs, names in os.walk(self.docs_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith(".") or not name.lower().endswith(self.extensions):
+                    continue
+                full_path = os.path.join(root, name)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                if st.st_size <= MAX_FILE_BYTES:
+                    found[os.path.relpath(full_path, self.docs_dir)] = (st.st_size, st.st_mtime_ns)
+        return found
+
+    def _read(self, path: str) -> Tuple[str, List[str]]:
+        with open(os.path.join(self.docs_dir, path), "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        if path.lower().endswith((".html", ".htm")):
+            title = re.search(r"<title[^>]*>(.*?)</title>", text, re.IGNORECASE | re.DOTALL)
+            text = TAG.sub(" ", text)
+            title = title.group(1).strip() if title else None
+        else:
+            heading = HEADING.search(text[:2000])
+            title = heading.group(2).strip() if heading else None
+        return title or os.path.splitext(os.path.basename(path))[0].replace("_", " "), split_passages(text)
+
+    def _delete_passages(self, row: Tuple[int, int, int, int]):
+        _, _, first_rowid, count = row
+        self._conn.execute("DELETE FROM passages WHERE rowid >= ? AND rowid < ?", (first_rowid, first_rowid + count))
+
+    def sync(self) -> Dict[str, int]:
+        """Brings the index in line with the documents directory. Returns counts of added/updated/removed files."""
+        with self._sync_lock: # One sync at a time; searches carry on between file batches
+            started = time.perf_counter()
+            if not os.path.isdir(self.docs_dir):
+                found = {}
+            else:
+                found = self._scan()
+            with self._lock:
+                known = {row[0]: row[1:] for row in self._conn.execute("SELECT path, size, mtime_ns, first_rowid, passages FROM files")}
+            changed = [path for path, signature in found.items() if path not in known or known[path][:2] != signature]
+            removed = [path for path in known if path not in found]
+            counts = {"added": sum(1 for p in changed if p not in known), "updated": sum(1 for p in changed if p in known), "removed": len(removed)}
+
+            if removed:
+                with self._lock:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        for path in removed:
+                            self._delete_passages(known[path])
+                        self._conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        raise
+            for path in changed:
+                try:
+                    title, passages = self._read(path)
+                except OSError as e:
+                    print(f"Error reading {path} for the search index: {e}")
+                    continue
+                with self._lock: # One transaction per file, so a half-indexed file is never visible
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        if path in known:
+                            self._delete_passages(known[path])
+                        first_rowid = self._conn.execute("SELECT COALESCE(MAX(rowid), 0) + 1 FROM passages").fetchone()[0]
+                        self._conn.executemany("INSERT INTO passages (rowid, path, title, body) VALUES (?, ?, ?, ?)",
+                                               [(first_rowid + i, path, title, body) for i, body in enumerate(passages)])
+                        self._conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, first_rowid, passages) VALUES (?, ?, ?, ?, ?)",
+                                           (path,) + found[path] + (first_rowid, len(passages)))
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        raise
+
+            if changed or removed:
+                with self._lock:
+                    if len(changed) + len(removed) > 50:
+                        self._conn.execute("INSERT INTO passages (passages) VALUES ('optimize')") # Merge the index segments
+                    self.stats["files"] = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+                    self.stats["passages"] = self._conn.execute("SELECT COUNT(*) FROM passages").fetchone()[0]
+                with self._cache_lock:
+                    self.cache.clear()
+            self.stats["last_sync"] = time.time()
+            self.stats["last_sync_seconds"] = time.perf_counter() - started
+            return counts
+    # ----------------
+
+    # --- Searching ---
+    def cached(self, query: str, limit: int) -> Optional[List[SearchResult]]:
+        """Results for a recent identical query, without touching the database (cheap enough for the event loop)."""
+        key = (" ".join(query.lower().split()), limit)
+        with self._cache_lock:
+            results = self.cache.get(key)
+            if results is not None:
+                self.cache.move_to_end(key)
+        if results is not None:
+            self.stats["queries"] += 1
+            self.stats["cache_hits"] += 1
+        return results
+
+    def search(self, query: str, limit: int = 3) -> List[SearchResult]:
+        """Best passages for `query`, at most one per file: all words must match, or failing that any of them."""
+        cached = self.cached(query, limit)
+        if cached is not None:
+            return cached
+        self.stats["queries"] += 1
+        results: List[SearchResult] = []
+        for any_term in (False, True):
+            expression = match_expression(query, any_term)
+            if expression is None:
+                break
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT path, title, snippet(passages, 2, '**', '**', '...', 32), bm25(passages, 0.0, 5.0, 1.0) AS rank "
+                    "FROM passages WHERE passages MATCH ? ORDER BY rank LIMIT ?", (expression, limit * 4)).fetchall()
+            seen = set()
+            for path, title, snippet, rank in rows:
+                if path not in seen:
+                    seen.add(path)
+                    results.append(SearchResult(path, title, " ".join(snippet.split()), rank))
+            results = results[:limit]
+            if results:
+                break
+        key = (" ".join(query.lower().split()), limit)
+        with self._cache_lock:
+            self.cache[key] = results
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
+    # -----------------
+
+
+def open_local_search(db_path: Optional[str], docs_dir: Optional[str], extensions: Sequence[str], cache_size: int) -> Optional[LocalSearch]:
+    """Opens the index, or returns None if search is disabled (empty path, or no documents directory) or it
+    can't be opened."""
+    if not db_path or not docs_dir or not os.path.isdir(docs_dir):
+        return None
+    try:
+        return LocalSearch(db_path, docs_dir, extensions=extensions, cache_size=cache_size)
+    except Exception as e:
+        print(f"Error opening local search index at {db_path}: {e}. search_internet will use its placeholder results.")
+        return None
@@ -0,0 +1,76 @@
+# utils/mock_gateway.py
+# Stand-in for bot.py that launcher.py runs with --mock. It never talks to Discord: each "shard" just
+# reports a made-up latency, and the cluster hammers the shared store with the same atomic
+# read-modify-write updates AICog uses, so the launcher, health reporting and cross-process state
+# can all be exercised locally. The fake history goes to the "mock_history" namespace, which AICog
+# never reads, in case the store is a real one (launcher.py --mock uses a throwaway store by default).
+import os
+import random
+import signal
+import time
+
+from utils.shared_store import SharedStore
+
+
+def run_mock_cluster():
+    store_path = os.environ["BOT_SHARED_STORE_PATH"]
+    cluster_id = int(os.getenv("BOT_CLUSTER_ID", "0"))
+    shard_ids = [int(s) for s in os.getenv("BOT_SHARD_IDS", "0").split(",") if s.strip()]
+    shard_count = int(os.getenv("BOT_SHARD_COUNT", str(len(shard_ids))))
+    health_interval = float(os.getenv("BOT_HEALTH_INTERVAL", "2"))
+    messages_per_second = float(os.getenv("MOCK_MESSAGES_PER_SECOND", "50"))
+    mock_users = int(os.getenv("MOCK_USERS", "200"))
+
+    store = SharedStore(store_path)
+    rng = random.Random(cluster_id)
+    # Each shard gets its own baseline latency so the health table shows something interesting
+    base_latency = {shard_id: rng.uniform(20, 120) for shard_id in shard_ids}
+    messages_written = 0
+    running = True
+
+    def _stop(*_):
+        nonlocal running
+        running = False
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    def _append_message(history):
+        history = history or []
+        history.append({"role": "user", "content": f"mock message from cluster {cluster_id}"})
+        return history[-20:]
+
+    print(f"[mock cluster {cluster_id}] shards {shard_ids} of {shard_count}, pid {os.getpid()}")
+    next_report = 0.0
+    while running:
+        now = time.time()
+        if now >= next_report:
+            store.set("cluster_health", str(cluster_id), {
+                "cluster_id": cluster_id,
+                "pid": os.getpid(),
+                "shard_ids": shard_ids,
+                "shard_count": shard_count,
+                "latency_ms": {str(s): round(base_latency[s] + rng.uniform(-10, 10), 1) for s in shard_ids},
+                "guilds": len(shard_ids) * 1000,
+                "ready": True,
+                "messages_written": messages_written,
+                "reported_at": now,
+            })
+            next_report = now + health_interval
+
+        # Same kind of write AICog.add_to_history does, against users every cluster shares
+        user_id = str(rng.randrange(mock_users))
+        store.update("mock_history", user_id, _append_message, [])
+        store.update("mock", "messages", lambda count: (count or 0) + 1, 0)
+        messages_written += 1
+        time.sleep(1.0 / messages_per_second)
+
+    # Final report so the launcher can check no updates were lost
+    health = store.get("cluster_health", str(cluster_id), {})
+    health.update({"messages_written": messages_written, "ready": False, "reported_at": time.time()})
+    store.set("cluster_health", str(cluster_id), health)
+    store.close()
+    print(f"[mock cluster {cluster_id}] stopped after {messages_written} messages")
+
+
+if __name__ == "__main__":
+    run_mock_cluster()
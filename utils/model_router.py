@@ -0,0 +1,170 @@
+# utils/model_router.py
+# Picks a model tier for each request before the API call. Greetings, one-liners and small talk go to a
+# small fast model with a short max_tokens; anything that looks like it needs a tool (remembering a fact,
+# a shell command, a search), long-form output or a longer conversation goes to the configured large
+# model. The classifier is a handful of precompiled regexes and length checks, so it costs microseconds.
+# The cog escalates to the large model when the small one asks for a tool or runs out of tokens.
+#
+# Every API call made under a routing decision can be appended to a JSONL log (tier, reason, confidence,
+# latency, tokens), and per-tier latency is kept in memory for !routing, so the rules below can be tuned.
+import asyncio
+import itertools
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from utils import json_codec
+
+SMALL, LARGE = "small", "large"
+
+GREETING = re.compile(
+    r"^\W*(hi+|hey+|hello+|yo|sup|hiya|heya|howdy|gm|gn|good (morning|night|evening|afternoon)|thanks?( you)?|thx|ty|"
+    r"lol+|lmao+|haha+|hehe+|ok(ay)?|k|bye+|cya|see ya|nice|cool|yay+|wow+|omg|same|nah|yep|yes|no|ily|love you)\b",
+    re.IGNORECASE,
+)
+TOOL_HINT = re.compile( # Things the model can only do with run_safe_shell_command / remember_fact_about_user
+    r"\b(remember|don'?t forget|my (name|birthday|favou?rite|pronouns)|i (like|love|hate|am|have|live|work)|"
+    r"run|command|shell|uptime|date|what time|ls|ping|search|look up|google|timeout)\b",
+    re.IGNORECASE,
+)
+LONG_FORM = re.compile(
+    r"(```|\b(explain|write|story|essay|poem|lyrics|song about|code|script|program|summari[sz]e|translate|"
+    r"list|compare|step[- ]by[- ]step|in detail|roleplay|rp)\b|\bhow (do|does|can|would|to)\b|\bwhy\b)",
+    re.IGNORECASE,
+)
+
+
+class RouteDecision(NamedTuple):
+    tier: str
+    model: str
+    max_tokens: Optional[int]
+    confidence: float
+    reason: str
+
+
+class ModelRouter:
+    """Routes requests between a small model and the configured (large) one; disabled without a small model."""
+
+    def __init__(self, small_model: Optional[str], small_max_tokens: int = 400, min_confidence: float = 0.6,
+                 log_path: Optional[str] = None):
+        self.small_model = small_model or None
+        self.small_max_tokens = small_max_tokens
+        self.min_confidence = min_confidence
+        self.log_path = log_path or None
+        self.stats = {tier: {"requests": 0, "calls": 0, "escalated": 0, "latency": deque(maxlen=500)} for tier in (SMALL, LARGE)}
+        self.reasons: Dict[str, int] = {}
+        self._ids = itertools.count(1)
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, default_log_path: str) -> "ModelRouter":
+        return cls(
+            os.getenv("AI_SMALL_MODEL"), # e.g. "Llama-3.1-8B-Instruct"; unset = every request uses the configured model
+            small_max_tokens=int(os.getenv("AI_SMALL_MAX_TOKENS", "400")),
+            min_confidence=float(os.getenv("AI_ROUTING_MIN_CONFIDENCE", "0.6")),
+            log_path=os.getenv("AI_ROUTING_LOG_PATH", default_log_path), # Empty disables the log
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.small_model is not None
+
+    # --- Classification ---
+    def classify(self, prompt: str, history: List[Dict[str, Any]]):
+        """(tier, confidence, reason) from the prompt's length and wording and the recent conversation."""
+        words = len(prompt.split())
+        if TOOL_HINT.search(prompt):
+            return LARGE, 0.9, "tool hint"
+        if LONG_FORM.search(prompt):
+            return LARGE, 0.8, "long-form"
+        if words > 40:
+            return LARGE, 0.8, "long prompt"
+        if words <= 6 and GREETING.match(prompt):
+            tier, confidence, reason = SMALL, 0.95, "greeting"
+        elif words <= 3:
+            tier, confidence, reason = SMALL, 0.85, "very short"
+        elif words <= 20:
+            tier, confidence, reason = SMALL, 0.75 if "?" not in prompt else 0.65, "short chat" if "?" not in prompt else "short question"
+        else:
+            tier, confidence, reason = LARGE, 0.6, "medium prompt"
+        # A conversation that's been going deep (long replies, tool results) is worth keeping on the large model
+        recent = [m for m in history[-6:] if m.get("role") in ("assistant", "tool")]
+        if tier == SMALL and recent:
+            if any(m.get("role") == "tool" for m in recent):
+                confidence -= 0.3
+            elif sum(len(m.get("content") or "") for m in recent) / len(recent) > 600:
+                confidence -= 0.2
+        return tier, round(confidence, 2), reason
+
+    def route(self, prompt: str, history: List[Dict[str, Any]], model: str, max_tokens: Optional[int],
+              pinned: bool = False) -> RouteDecision:
+        """Decision for one request; `model`/`max_tokens` are the configured (large tier) values.
+        `pinned` means a user/guild picked the model themselves, so it's used as-is."""
+        if not self.enabled:
+            return RouteDecision(LARGE, model, max_tokens, 1.0, "routing off")
+        if pinned:
+            self.stats[LARGE]["requests"] += 1
+            return RouteDecision(LARGE, model, max_tokens, 1.0, "model pinned")
+        tier, confidence, reason = self.classify(prompt, history)
+        if tier == SMALL and confidence < self.min_confidence:
+            tier, reason = LARGE, f"{reason}, low confidence"
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        self.stats[tier]["requests"] += 1
+        if tier == SMALL:
+            limit = min(max_tokens, self.small_max_tokens) if max_tokens else self.small_max_tokens
+            return RouteDecision(SMALL, self.small_model, limit, confidence, reason)
+        return RouteDecision(LARGE, model, max_tokens, confidence, reason)
+
+    def escalate(self, decision: RouteDecision, model: str, max_tokens: Optional[int], why: str) -> RouteDecision:
+        """Moves a small-tier request to the large model (the small one wanted a tool, or ran out of tokens)."""
+        self.stats[SMALL]["escalated"] += 1
+        self.stats[LARGE]["requests"] += 1
+        return RouteDecision(LARGE, model, max_tokens, decision.confidence, f"{decision.reason}, escalated: {why}")
+    # ----------------------
+
+    # --- Logging ---
+    def new_request_id(self) -> str:
+        return f"{os.getpid()}-{next(self._ids)}"
+
+    def record_call(self, request_id: str, decision: RouteDecision, latency: float, status: Any,
+                    usage: Optional[dict] = None, finish_reason: Optional[str] = None):
+        """Per-tier latency for !routing, plus one line in the routing log."""
+        stats = self.stats[decision.tier]
+        stats["calls"] += 1
+        stats["latency"].append(latency)
+        if not self.log_path or not self.enabled:
+            return
+        usage = usage or {}
+        line = json_codec.dumps({
+            "ts": round(time.time(), 3), "request": request_id, "tier": decision.tier, "model": decision.model,
+            "max_tokens": decision.max_tokens, "confidence": decision.confidence, "reason": decision.reason,
+            "latency": round(latency, 4), "status": status, "finish_reason": finish_reason,
+            "prompt_tokens": usage.get("prompt_tokens"), "completion_tokens": usage.get("completion_tokens"),
+        }) + b"\n"
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write, line)
+        except RuntimeError:
+            self._write(line)
+
+    def _write(self, line: bytes):
+        try:
+            with self._write_lock:
+                with open(self.log_path, "ab") as f:
+                    f.write(line)
+        except Exception as e:
+            print(f"Error writing routing log to {self.log_path}: {e}")
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for tier, stats in self.stats.items():
+            ordered = sorted(stats["latency"])
+            result[tier] = {
+                "requests": stats["requests"], "calls": stats["calls"], "escalated": stats["escalated"],
+                "p50": ordered[len(ordered) // 2] if ordered else None,
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+            }
+        return result
+    # ---------------
@@ -0,0 +1,163 @@
+# utils/shared_store.py
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from utils import json_codec
+
+
+class SharedStore:
+    """SQLite-backed key/value store that every cluster process can open at the same time.
+
+    Values are stored as JSON text (via utils.json_codec) under a (namespace, key) pair. The
+    database runs in WAL mode so readers never block the writer, and read-modify-write updates go through `update`, which
+    holds an IMMEDIATE transaction so two processes can't lose each other's changes.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        # isolation_level=None -> we manage transactions ourselves (BEGIN IMMEDIATE in update())
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock() # One connection per process, shared between threads
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Single-key access ---
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        """Returns the decoded value for a key, or `default` if it isn't stored."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        if row is None:
+            return default
+        return json_codec.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any):
+        """Stores (or replaces) the value for a key."""
+        encoded = json_codec.dumps_str(value)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (namespace, key, encoded, time.time()),
+            )
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any], default: Any = None) -> Any:
+        """Atomically applies `fn` to the stored value and writes the result back.
+
+        If `fn` returns None the key is deleted. Returns the new value.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+                current = json_codec.loads(row[0]) if row is not None else default
+                new_value = fn(current)
+                if new_value is None:
+                    self._conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+                else:
+                    self._conn.execute(
+                        "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                        (namespace, key, json_codec.dumps_str(new_value), time.time()),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return new_value
+
+    # --- Whole-namespace access ---
+    def items(self, namespace: str) -> Dict[str, Any]:
+        """Returns every key/value pair in a namespace."""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json_codec.loads(value) for key, value in rows}
+
+    def items_with_age(self, namespace: str) -> Dict[str, tuple]:
+        """Like `items`, but each value comes back as (value, seconds_since_last_write)."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value, updated_at FROM kv WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {key: (json_codec.loads(value), now - updated_at) for key, value, updated_at in rows}
+
+    def replace_namespace(self, namespace: str, mapping: Dict[str, Any]):
+        """Replaces the whole namespace with `mapping` in one transaction."""
+        now = time.time()
+        rows = [(namespace, str(key), json_codec.dumps_str(value), now) for key, value in mapping.items()]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+                self._conn.executemany(
+                    "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)", rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_many(self, namespace: str, mapping: Dict[str, Any]):
+        """Stores several keys in one transaction."""
+        now = time.time()
+        rows = [(namespace, str(key), json_codec.dumps_str(value), now) for key, value in mapping.items()]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def keys(self, namespace: str) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT key FROM kv WHERE namespace = ?", (namespace,))]
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM kv WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+
+def open_shared_store(path: Optional[str] = None) -> Optional[SharedStore]:
+    """Opens the shared store named by BOT_SHARED_STORE_PATH (or `path`), or returns None if unset."""
+    path = path or os.getenv("BOT_SHARED_STORE_PATH")
+    if not path:
+        return None
+    try:
+        return SharedStore(path)
+    except Exception as e:
+        print(f"Error opening shared store at {path}: {e}. Falling back to local JSON files.")
+        return None
@@ -0,0 +1,117 @@
+# utils/state_snapshot.py
+# Binary snapshot of the AI cog's in-memory state, for fast warm restarts. Parsing the pretty-printed JSON
+# files dominates startup once memory and history grow; the snapshot holds the same data as one pickle
+# of plain builtin containers behind a small header, and is memory-mapped on load. Every snapshot records
+# the size and mtime of the JSON files it mirrors: if any of them was written after the snapshot (or edited
+# by hand), the snapshot is stale and the caller loads the JSON files instead.
+import gc
+import io
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+FORMAT_VERSION = 1 # Bump when the header or the layout of the pickled state changes
+MAGIC = b"RLSNAP"
+HEADER = struct.Struct("<6sHIQ") # magic, format version, crc32 of the payload, payload length
+
+
+class SnapshotError(Exception):
+    """The snapshot exists but can't be used (corrupt, other format version, or stale)."""
+
+
+class _BuiltinsOnly(pickle.Unpickler):
+    # Dicts, lists, tuples, strings, bytes and numbers never go through find_class, so refusing it means
+    # loading a snapshot can't construct arbitrary objects
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"snapshot may only contain builtin types, found {module}.{name}")
+
+
+@contextmanager
+def gc_paused():
+    """Suspends the cyclic GC while loading. Startup allocates millions of long-lived containers, and the
+    collections they trigger along the way (which free nothing) cost more than the loading itself."""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def source_stamps(paths: Iterable[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+    """{path: (mtime_ns, size)} for each file, None for the ones that don't exist."""
+    stamps = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamps[path] = None
+    return stamps
+
+
+def encode(state: Dict[str, Any], sources: Iterable[str]) -> bytes:
+    """Serializes `state` (a tree of builtin containers, no cycles) with the current stamps of `sources`."""
+    buffer = io.BytesIO()
+    buffer.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0)) # Filled in below
+    pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.fast = True # No memo: ~4x faster, and fine because nothing in the state is shared or cyclic
+    pickler.dump({"sources": source_stamps(sources), "written_at": time.time(), "state": state})
+    data = buffer.getbuffer()
+    payload = data[HEADER.size:]
+    HEADER.pack_into(data, 0, MAGIC, FORMAT_VERSION, zlib.crc32(payload), len(payload))
+    payload.release()
+    data.release()
+    return buffer.getvalue()
+
+
+def write(path: str, data: bytes):
+    """Writes an encoded snapshot atomically (temp file + rename), so a crash never leaves half a snapshot."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load(path: str, sources: Iterable[str]) -> Optional[Dict[str, Any]]:
+    """Returns the snapshot's state, or None if there is no snapshot. Raises SnapshotError if it can't be used."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise SnapshotError("truncated header")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, version, crc, length = HEADER.unpack_from(mapped)
+            if magic != MAGIC:
+                raise SnapshotError("not a state snapshot")
+            if version != FORMAT_VERSION:
+                raise SnapshotError(f"format version {version}, expected {FORMAT_VERSION}")
+            if HEADER.size + length != size:
+                raise SnapshotError("truncated payload")
+            view = memoryview(mapped)[HEADER.size:]
+            try:
+                if zlib.crc32(view) != crc:
+                    raise SnapshotError("checksum mismatch")
+            finally:
+                view.release() # The map can't close while a view into it is alive
+            mapped.seek(HEADER.size)
+            try:
+                snapshot = _BuiltinsOnly(mapped).load()
+            except Exception as e:
+                raise SnapshotError(f"undecodable payload: {e}") from e
+    current = source_stamps(sources)
+    if snapshot["sources"] != current:
+        changed = sorted(p for p in set(current) | set(snapshot["sources"]) if current.get(p) != snapshot["sources"].get(p))
+        raise SnapshotError(f"stale, changed since it was written: {', '.join(changed)}")
+    return snapshot["state"]
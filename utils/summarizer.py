@@ -0,0 +1,49 @@
+# utils/summarizer.py
+# Small local extractive summarizer used to compact old conversation turns into a
+# "story so far" entry when no summary model is configured. No dependencies: it scores
+# sentences by the frequency of their content words and keeps the best ones in order.
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+_WORD = re.compile(r"[a-zA-Z0-9']+")
+_STOPWORDS = frozenset(
+    "a an the and or but if then so to of in on at for with from by is are was were be been being am "
+    "i you he she it we they me him her us them my your his its our their this that these those "
+    "do does did have has had not no yes just like what who how why when where can could would should "
+    "will shall may might must about into over than too very really oh ok okay lol haha yay ehh".split()
+)
+
+
+def _content_words(text: str) -> List[str]:
+    return [w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS and len(w) > 2]
+
+
+def extractive_summary(messages: List[Dict[str, str]], previous_summary: Optional[str] = None,
+                       max_sentences: int = 6, max_chars: int = 900) -> str:
+    """Summarizes API-shaped messages into a few of their most representative sentences."""
+    labels = {"user": "User", "assistant": "Rin & Len"}
+    sentences = [] # (position, label, sentence)
+    for message in messages:
+        label = labels.get(message.get("role"), "Note")
+        for sentence in _SENTENCE_SPLIT.split(message.get("content") or ""):
+            sentence = sentence.strip()
+            if len(sentence) >= 12:
+                sentences.append((len(sentences), label, sentence))
+
+    frequencies = Counter(w for _, _, s in sentences for w in _content_words(s))
+    def _score(sentence: str) -> float:
+        words = _content_words(sentence)
+        return sum(frequencies[w] for w in words) / (len(words) + 3) if words else 0.0
+
+    best = sorted(sentences, key=lambda item: _score(item[2]), reverse=True)[:max_sentences]
+    picked = [f"{label}: {sentence}" for _, label, sentence in sorted(best)]
+
+    parts = [previous_summary.strip()] if previous_summary else []
+    parts.extend(picked)
+    summary = " ".join(parts)
+    if len(summary) > max_chars:
+        # Keep the newest material; the oldest summary text is the first to go
+        summary = "..." + summary[-(max_chars - 3):]
+    return summary
@@ -0,0 +1,218 @@
+# utils/tracing.py
+# Per-reply tracing: one trace per reply, from the triggering message to the Discord send, with a span for
+# each stage (debounce, scheduler queue, prompt assembly, every API iteration, tool calls, history saves,
+# the reply). The current span lives in a contextvar, so code called from inside a traced reply (and tasks
+# it creates) nests its spans without passing anything around; outside a trace, spans are no-ops.
+#
+# Finished traces are appended to a JSONL file, one OTLP/JSON ExportTraceServiceRequest per line (the format
+# the OpenTelemetry Collector's otlpjsonfile receiver reads), and the most recent ones are kept in memory
+# for the owner commands.
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from utils import json_codec
+
+SERVICE_NAME = "rin-and-len"
+STATUS_OK, STATUS_ERROR = 1, 2 # OTLP status codes
+SPAN_KIND_INTERNAL = 1
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("ai_trace_span", default=None)
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}} # OTLP/JSON encodes int64 as a string
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], start_ns: int, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns # time.monotonic_ns(); converted to wall time on export
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        trace.spans.append(self)
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def fail(self, error: str):
+        self.error = error
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.monotonic_ns()
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.monotonic_ns()) - self.start_ns) / 1e9
+
+
+class _NoopSpan:
+    """Stands in for a span when the reply isn't sampled (or there is no trace at all)."""
+    __slots__ = ()
+
+    def set(self, **attributes: Any):
+        pass
+
+    def fail(self, error: str):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "root")
+
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+
+class Tracer:
+    """Samples traces at `sample_rate`, exports them to `path` (if set) and keeps the last `keep` in memory."""
+
+    def __init__(self, path: Optional[str], sample_rate: float = 1.0, keep: int = 200, max_bytes: int = 0):
+        self.path = path or None
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.max_bytes = max_bytes # Past this the file is rotated to <path>.1 (0 = never)
+        self.recent: Deque[Trace] = deque(maxlen=keep)
+        self.stats = {"sampled": 0, "skipped": 0, "export_errors": 0}
+        self._wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, default_path: str) -> "Tracer":
+        return cls(
+            os.getenv("AI_TRACE_PATH", default_path), # Empty = keep traces in memory only
+            sample_rate=float(os.getenv("AI_TRACE_SAMPLE_RATE", "1.0")),
+            keep=int(os.getenv("AI_TRACE_KEEP", "200")),
+            max_bytes=int(float(os.getenv("AI_TRACE_MAX_MB", "50")) * 1024 * 1024),
+        )
+
+    @contextmanager
+    def trace(self, name: str, started_at: Optional[float] = None, **attributes: Any):
+        """Root span of a new trace, or a no-op if this one isn't sampled. `started_at` (time.monotonic())
+        backdates the start, e.g. to when the triggering message arrived."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            self.stats["skipped"] += 1
+            token = _current.set(None) # Spans below this point are no-ops, even inside another trace
+            try:
+                yield NOOP_SPAN
+            finally:
+                _current.reset(token)
+            return
+        self.stats["sampled"] += 1
+        trace = Trace()
+        start_ns = int(started_at * 1e9) if started_at is not None else time.monotonic_ns()
+        root = trace.root = Span(trace, name, None, start_ns, attributes)
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.fail(type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            self._finish(trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any):
+        """Child of the current span for the duration of the block; a no-op outside a sampled trace."""
+        parent = _current.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        span = Span(parent.trace, name, parent.span_id, time.monotonic_ns(), attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    def start_span(self, name: str, **attributes: Any):
+        """Child of the current span that the caller ends with .end() (for waits that don't fit a block).
+        It doesn't become the current span."""
+        parent = _current.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(parent.trace, name, parent.span_id, time.monotonic_ns(), attributes)
+
+    def _finish(self, trace: Trace):
+        trace.root.end()
+        for span in trace.spans:
+            if span.end_ns is None: # Never ended, e.g. a queue wait the reply was cancelled in
+                span.end_ns = trace.root.end_ns
+                span.error = span.error or "unfinished"
+        self.recent.append(trace)
+        if self.path:
+            line = json_codec.dumps(self.to_otlp(trace)) + b"\n"
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self._write, line)
+            except RuntimeError: # No loop (worker shutdown, scripts)
+                self._write(line)
+
+    def _write(self, line: bytes):
+        try:
+            with self._write_lock:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, "ab") as f:
+                    f.write(line)
+        except Exception as e:
+            self.stats["export_errors"] += 1
+            print(f"Error writing trace to {self.path}: {e}")
+
+    def to_otlp(self, trace: Trace) -> Dict[str, Any]:
+        spans = []
+        for span in trace.spans:
+            record = {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(span.start_ns + self._wall_offset_ns),
+                "endTimeUnixNano": str(span.end_ns + self._wall_offset_ns),
+                "attributes": [_attribute(k, v) for k, v in span.attributes.items() if v is not None],
+                "status": {"code": STATUS_ERROR, "message": span.error} if span.error else {"code": STATUS_OK},
+            }
+            if span.parent_id:
+                record["parentSpanId"] = span.parent_id
+            spans.append(record)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", SERVICE_NAME), _attribute("process.pid", os.getpid())]},
+            "scopeSpans": [{"scope": {"name": "utils.tracing"}, "spans": spans}],
+        }]}
+
+    def slowest(self, count: int = 5) -> List[Trace]:
+        return sorted(self.recent, key=lambda trace: trace.duration, reverse=True)[:count]
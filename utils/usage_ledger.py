@@ -0,0 +1,163 @@
+# utils/usage_ledger.py
+# Token usage per user, guild and UTC day, from the `usage` block of each API response, plus the daily
+# budgets built on it. Only aggregates are stored: one row per (day, scope, key) with request, API
+# iteration and token counters, in a small SQLite file every process (gateway and AI workers) adds to.
+# Records are counted in memory and written in batches by `flush` (the cog calls it every
+# AI_USAGE_FLUSH_SECONDS); budget checks read the stored row, refreshed at the same interval, plus
+# whatever this process hasn't flushed yet.
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+COUNTERS = ("requests", "iterations", "prompt_tokens", "completion_tokens", "total_tokens")
+TOTAL = COUNTERS.index("total_tokens")
+ALL_KEY = "*" # scope "all": the whole bot's usage that day
+
+
+def today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class BudgetDecision(NamedTuple):
+    level: str # "ok", "soft" (over the soft threshold: shed load) or "exhausted" (refuse)
+    scope: Optional[str] = None # "user" or "guild": the budget that decided it
+    used: int = 0
+    limit: int = 0
+
+
+OK = BudgetDecision("ok")
+
+
+class UsageLedger:
+    def __init__(self, path: str, refresh: float = 30.0, retention_days: int = 90, timeout: float = 30.0):
+        self.path = path
+        self.refresh = refresh
+        self.retention_days = retention_days
+        ledger_dir = os.path.dirname(path)
+        if ledger_dir and not os.path.exists(ledger_dir):
+            os.makedirs(ledger_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                " day TEXT NOT NULL, scope TEXT NOT NULL, key TEXT NOT NULL,"
+                " requests INTEGER NOT NULL, iterations INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL,"
+                " completion_tokens INTEGER NOT NULL, total_tokens INTEGER NOT NULL,"
+                " PRIMARY KEY (day, scope, key)) WITHOUT ROWID"
+            )
+        self._pending: Dict[Tuple[str, str, str], List[int]] = {} # Counted here, not yet written
+        self._stored: Dict[Tuple[str, str, str], Tuple[float, List[int]]] = {} # (read at, stored counters)
+        self._pruned_day: Optional[str] = None
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    # --- Recording ---
+    def record(self, user_id: str, guild_id: Optional[str], usage: Optional[dict], first_iteration: bool):
+        """Counts one API response. `first_iteration` marks the first call of a request (tool loops make more)."""
+        usage = usage or {}
+        prompt = int(usage.get("prompt_tokens") or 0)
+        completion = int(usage.get("completion_tokens") or 0)
+        delta = (int(first_iteration), 1, prompt, completion, int(usage.get("total_tokens") or prompt + completion))
+        day = today()
+        keys = [(day, "user", str(user_id)), (day, "all", ALL_KEY)]
+        if guild_id:
+            keys.append((day, "guild", str(guild_id)))
+        for key in keys:
+            counters = self._pending.get(key)
+            if counters is None:
+                counters = self._pending[key] = [0] * len(COUNTERS)
+            for i, value in enumerate(delta):
+                counters[i] += value
+
+    def flush(self):
+        """Adds the pending counts to the stored rows (in one transaction) and drops days past retention."""
+        if not self._pending:
+            return
+        rows = [key + tuple(counters) for key, counters in self._pending.items()]
+        self._pending = {}
+        update = ", ".join(f"{c} = {c} + excluded.{c}" for c in COUNTERS)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    f"INSERT INTO usage (day, scope, key, {', '.join(COUNTERS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    f"ON CONFLICT(day, scope, key) DO UPDATE SET {update}", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                for row in rows: # Keep the counts for the next flush
+                    counters = self._pending.setdefault(row[:3], [0] * len(COUNTERS))
+                    for i, value in enumerate(row[3:]):
+                        counters[i] += value
+                raise
+        for row in rows:
+            self._stored.pop(row[:3], None) # Re-read on next use
+        day = today()
+        if self._pruned_day != day and self.retention_days > 0:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+            with self._lock:
+                self._conn.execute("DELETE FROM usage WHERE day < ?", (cutoff,))
+            self._stored = {key: value for key, value in self._stored.items() if key[0] == day}
+            self._pruned_day = day
+    # -----------------
+
+    # --- Reading ---
+    def used(self, scope: str, key: str) -> int:
+        """Tokens used today by a user/guild, across all processes (as of the last refresh) plus ours not yet flushed."""
+        row_key = (today(), scope, str(key))
+        cached = self._stored.get(row_key)
+        now = time.monotonic()
+        if cached is None or now - cached[0] > self.refresh:
+            with self._lock:
+                row = self._conn.execute(
+                    f"SELECT {', '.join(COUNTERS)} FROM usage WHERE day = ? AND scope = ? AND key = ?", row_key).fetchone()
+            cached = self._stored[row_key] = (now, list(row) if row else [0] * len(COUNTERS))
+        pending = self._pending.get(row_key)
+        return cached[1][TOTAL] + (pending[TOTAL] if pending else 0)
+
+    def top(self, scope: str, days: int = 1, limit: int = 10) -> List[Dict[str, int]]:
+        """Heaviest users/guilds over the last `days` UTC days (today included), most total tokens first."""
+        self.flush()
+        since = (datetime.now(timezone.utc) - timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+        sums = ", ".join(f"SUM({c})" for c in COUNTERS)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, {sums} FROM usage WHERE scope = ? AND day >= ? GROUP BY key ORDER BY SUM(total_tokens) DESC LIMIT ?",
+                (scope, since, limit)).fetchall()
+        return [dict(zip(("key",) + COUNTERS, row)) for row in rows]
+    # ---------------
+
+    # --- Budgets ---
+    def check(self, user_id: str, guild_id: Optional[str], user_limit: int, guild_limit: int, soft_fraction: float) -> BudgetDecision:
+        """Compares today's usage with the daily limits (0 = no limit); the most exhausted budget decides."""
+        decision = OK
+        for scope, key, limit in (("user", user_id, user_limit), ("guild", guild_id, guild_limit)):
+            if not limit or not key:
+                continue
+            used = self.used(scope, key)
+            if used >= limit:
+                return BudgetDecision("exhausted", scope, used, limit)
+            if used >= limit * soft_fraction and decision.level == "ok":
+                decision = BudgetDecision("soft", scope, used, limit)
+        return decision
+    # ---------------
+
+
+def open_usage_ledger(path: Optional[str], refresh: float, retention_days: int) -> Optional[UsageLedger]:
+    """Opens the ledger at `path`, or returns None if it's disabled (empty path) or can't be opened."""
+    if not path:
+        return None
+    try:
+        return UsageLedger(path, refresh=refresh, retention_days=retention_days)
+    except Exception as e:
+        print(f"Error opening usage ledger at {path}: {e}. Token usage won't be recorded.")
+        return None
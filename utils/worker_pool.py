@@ -0,0 +1,302 @@
+# utils/worker_pool.py
+# Runs AI generations in separate worker processes so the gateway process only has to receive events
+# and send replies. The gateway talks to the workers through multiprocessing queues using the small
+# message schema below; each worker owns its own HTTP session and opens the shared store itself.
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from dataclasses import dataclass, asdict, field
+from typing import Any, Callable, Dict, List, Optional
+
+LIVENESS_CHECK_SECONDS = 1.0 # How often dead workers are looked for, however busy the result queue is
+SCHEMA_VERSION = 4 # 2: GenerateJob.channel_context, 3: GenerateJob.load_level, 4: CommitJob
+
+# --- Queue Message Schema ---
+# Every message on a queue is a plain dict: {"v": SCHEMA_VERSION, "type": <type>, ...fields}
+#   gateway -> worker: "job" (GenerateJob), "cancel" (CancelJob), "commit" (CommitJob), "shutdown" (no fields)
+#   worker -> gateway: "result" (JobResult), "ready" ({"worker_id": int})
+#
+# A finished job's conversation turn is only written to history once the gateway has taken its result:
+# the gateway answers an "ok" result with "commit", and a job it gave up on with "cancel" (which also
+# drops a turn that was held back). So a reply that never gets sent never shows up in history either.
+
+
+@dataclass
+class GenerateJob:
+    job_id: str
+    user_id: str
+    user_name: str
+    prompt: str
+    guild_id: Optional[int] = None
+    channel_id: Optional[int] = None
+    channel_context: Optional[str] = None # Recent channel messages, rendered by the gateway
+    load_level: int = 0 # The gateway's load-shedding level (utils/load_watchdog.py) when the job was queued
+    submitted_at: float = field(default_factory=time.time)
+    type: str = "job"
+
+
+@dataclass
+class CancelJob:
+    job_id: str
+    type: str = "cancel"
+
+
+@dataclass
+class CommitJob:
+    job_id: str
+    type: str = "commit"
+
+
+@dataclass
+class JobResult:
+    job_id: str
+    status: str # "ok", "cancelled" or "error"
+    response: str = ""
+    error: str = ""
+    worker_id: int = -1
+    elapsed: float = 0.0
+    type: str = "result"
+
+
+_MESSAGE_TYPES = {"job": GenerateJob, "cancel": CancelJob, "commit": CommitJob, "result": JobResult}
+
+
+def encode_message(message) -> Dict[str, Any]:
+    data = asdict(message)
+    data["v"] = SCHEMA_VERSION
+    return data
+
+
+def decode_message(data: Dict[str, Any]):
+    """Turns a queue dict back into its dataclass. Unknown types come back as the raw dict."""
+    if data.get("v") != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported worker message schema version: {data.get('v')}")
+    message_cls = _MESSAGE_TYPES.get(data.get("type"))
+    if message_cls is None:
+        return data
+    fields = {k: v for k, v in data.items() if k != "v"}
+    return message_cls(**fields)
+# ----------------------------
+
+
+# --- Worker Process ---
+def _load_engine_factory(path: str):
+    """Resolves 'module.path:function' to the callable that builds a worker's engine."""
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def worker_main(worker_id: int, engine_factory_path: str, inbox, results):
+    """Entry point of a worker process."""
+    asyncio.run(_worker_loop(worker_id, engine_factory_path, inbox, results))
+
+
+async def _worker_loop(worker_id: int, engine_factory_path: str, inbox, results):
+    loop = asyncio.get_running_loop()
+    engine = _load_engine_factory(engine_factory_path)()
+    if hasattr(engine, "start_background_tasks"):
+        engine.start_background_tasks()
+    running: Dict[str, asyncio.Task] = {}
+    results.put({"v": SCHEMA_VERSION, "type": "ready", "worker_id": worker_id})
+    print(f"AI worker {worker_id} ready (pid {os.getpid()})")
+
+    async def _run(job: GenerateJob):
+        started = time.monotonic()
+        try:
+            response = await engine.run_job(job)
+            result = JobResult(job.job_id, "ok", response=response)
+        except asyncio.CancelledError:
+            result = JobResult(job.job_id, "cancelled")
+        except Exception as e:
+            traceback.print_exc()
+            result = JobResult(job.job_id, "error", error=f"{type(e).__name__}: {e}")
+        finally:
+            running.pop(job.job_id, None)
+        result.worker_id = worker_id
+        result.elapsed = time.monotonic() - started
+        results.put(encode_message(result))
+
+    while True:
+        data = await loop.run_in_executor(None, inbox.get)
+        if data.get("type") == "shutdown":
+            break
+        try:
+            message = decode_message(data)
+        except ValueError as e:
+            print(f"AI worker {worker_id}: dropping message: {e}")
+            continue
+        if isinstance(message, GenerateJob):
+            running[message.job_id] = loop.create_task(_run(message))
+        elif isinstance(message, CancelJob):
+            task = running.get(message.job_id)
+            if task:
+                task.cancel()
+            elif hasattr(engine, "discard_job"):
+                engine.discard_job(message.job_id) # Finished, but the gateway dropped the result
+        elif isinstance(message, CommitJob):
+            if hasattr(engine, "commit_job"):
+                engine.commit_job(message.job_id)
+
+    for task in list(running.values()):
+        task.cancel()
+    await asyncio.gather(*running.values(), return_exceptions=True)
+    if hasattr(engine, "close"):
+        await engine.close()
+# ----------------------
+
+
+class WorkerPool:
+    """Gateway-side handle for a pool of AI worker processes."""
+
+    def __init__(self, size: int, engine_factory_path: str, job_timeout: float = 180.0):
+        self.size = max(1, size)
+        self.engine_factory_path = engine_factory_path
+        self.job_timeout = job_timeout
+        self._ctx = multiprocessing.get_context("spawn") # Never fork the gateway's discord.py state
+        self._results = self._ctx.Queue()
+        self._inboxes = []
+        self._processes = []
+        self._outstanding = [] # Jobs in flight per worker, for least-loaded dispatch
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._job_worker: Dict[str, int] = {}
+        self._on_commit: Dict[str, Callable[[], None]] = {}
+        self._ids = itertools.count(1)
+        self._reader_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self._reader_task is not None and not self._closing
+
+    def start(self):
+        for worker_id in range(self.size):
+            self._inboxes.append(self._ctx.Queue())
+            self._processes.append(None)
+            self._outstanding.append(0)
+            self._spawn(worker_id)
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_results())
+        print(f"Started {self.size} AI worker process(es).")
+
+    def _spawn(self, worker_id: int):
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(worker_id, self.engine_factory_path, self._inboxes[worker_id], self._results),
+            name=f"ai-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    async def submit(self, user_id: str, user_name: str, prompt: str, guild_id: Optional[int] = None,
+                     channel_id: Optional[int] = None, channel_context: Optional[str] = None, load_level: int = 0,
+                     on_commit: Optional[Callable[[], None]] = None) -> JobResult:
+        """Queues a generation and waits for its result. Cancelling the caller cancels the job in the worker.
+
+        `on_commit` is called as soon as an "ok" result arrives, before the caller is woken: from then on
+        the turn is being written to history, so the caller shouldn't be cancelled any more.
+        """
+        job = GenerateJob(f"{os.getpid()}-{next(self._ids)}", str(user_id), user_name, prompt, guild_id, channel_id,
+                          channel_context, load_level=load_level)
+        worker_id = min(range(self.size), key=lambda w: self._outstanding[w])
+        future = asyncio.get_running_loop().create_future()
+        self._pending[job.job_id] = future
+        self._job_worker[job.job_id] = worker_id
+        if on_commit is not None:
+            self._on_commit[job.job_id] = on_commit
+        self._outstanding[worker_id] += 1
+        self._inboxes[worker_id].put(encode_message(job))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.job_timeout)
+        except asyncio.TimeoutError:
+            self.cancel(job.job_id)
+            return JobResult(job.job_id, "error", error="timed out waiting for worker", worker_id=worker_id)
+        except asyncio.CancelledError:
+            self.cancel(job.job_id)
+            raise
+
+    def cancel(self, job_id: str):
+        """Asks the worker holding `job_id` to cancel it. The job's result is dropped."""
+        worker_id = self._job_worker.get(job_id)
+        if worker_id is None:
+            return
+        self._inboxes[worker_id].put(encode_message(CancelJob(job_id)))
+        self._finish(job_id, None)
+
+    def _finish(self, job_id: str, result: Optional[JobResult]):
+        future = self._pending.pop(job_id, None)
+        worker_id = self._job_worker.pop(job_id, None)
+        on_commit = self._on_commit.pop(job_id, None)
+        if worker_id is not None:
+            self._outstanding[worker_id] -= 1
+        if future and not future.done():
+            if result is None:
+                future.cancel()
+                return
+            if result.status == "ok" and worker_id is not None:
+                self._inboxes[worker_id].put(encode_message(CommitJob(job_id)))
+                if on_commit is not None:
+                    on_commit()
+            future.set_result(result)
+
+    async def _read_results(self):
+        loop = asyncio.get_running_loop()
+        last_check = time.monotonic()
+        while not self._closing:
+            # Checked on a timer rather than only when the queue goes quiet: under steady load it never does
+            if time.monotonic() - last_check >= LIVENESS_CHECK_SECONDS:
+                last_check = time.monotonic()
+                self._check_workers()
+            try:
+                data = await loop.run_in_executor(None, self._results.get, True, LIVENESS_CHECK_SECONDS)
+            except queue.Empty:
+                continue
+            if data.get("type") == "ready":
+                continue
+            try:
+                message = decode_message(data)
+            except ValueError as e:
+                print(f"WorkerPool: dropping message: {e}")
+                continue
+            if isinstance(message, JobResult):
+                self._finish(message.job_id, message)
+
+    def _check_workers(self):
+        """Restarts dead workers and fails the jobs they were holding."""
+        for worker_id, process in enumerate(self._processes):
+            if process is None or process.is_alive() or self._closing:
+                continue
+            print(f"AI worker {worker_id} died (exit code {process.exitcode}); restarting.")
+            for job_id, owner in list(self._job_worker.items()):
+                if owner == worker_id:
+                    self._finish(job_id, JobResult(job_id, "error", error="worker process died", worker_id=worker_id))
+            self._spawn(worker_id)
+
+    def pids(self) -> List[int]:
+        return [p.pid for p in self._processes if p is not None and p.is_alive()]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.size,
+            "alive": sum(1 for p in self._processes if p is not None and p.is_alive()),
+            "outstanding": list(self._outstanding),
+        }
+
+    async def close(self):
+        self._closing = True
+        for job_id in list(self._pending):
+            self.cancel(job_id)
+        for inbox in self._inboxes:
+            inbox.put({"v": SCHEMA_VERSION, "type": "shutdown"})
+        if self._reader_task:
+            self._reader_task.cancel()
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            if process is not None:
+                await loop.run_in_executor(None, process.join, 10)
+                if process.is_alive():
+                    process.terminate()